@@ -0,0 +1,41 @@
+"""
+Throughput and peak memory of delegator.chain, buffered vs. direct pipes.
+
+    python benchmarks/bench_chain.py [direct_bytes] [buffered_bytes]
+
+Each mode runs in its own interpreter so peak RSS is measured in isolation.
+"""
+import resource
+import subprocess
+import sys
+import time
+
+from conger import delegator
+
+PIPELINE = 'head -c {size} /dev/zero | cat | cat | wc -c'
+
+
+def run(mode: str, size: int):
+    start = time.perf_counter()
+    if mode == 'direct':
+        c = delegator.chain(PIPELINE.format(size=size), direct=True)
+    else:
+        c = delegator.chain(PIPELINE.format(size=size), timeout=None)
+    out = c.out.strip()
+    c.block()
+    elapsed = time.perf_counter() - start
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(f'{mode:9} {size / 2 ** 20:8.0f} MiB  {elapsed:7.2f}s  {size / 2 ** 20 / elapsed:8.1f} MiB/s  '
+          f'peak RSS {peak:7.1f} MiB  (wc: {out})')
+
+
+def main(direct_size: int = 4 * 2 ** 30, buffered_size: int = 8 * 2 ** 20):
+    for mode, size in (('direct', direct_size), ('buffered', buffered_size)):
+        subprocess.run([sys.executable, __file__, '--mode', mode, str(size)], check=True)
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--mode']:
+        run(sys.argv[2], int(sys.argv[3]))
+    else:
+        main(*map(int, sys.argv[1:]))
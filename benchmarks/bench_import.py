@@ -0,0 +1,34 @@
+"""
+Startup time of `import conger`, headless vs. with the runtime backends loaded.
+
+    python benchmarks/bench_import.py [iterations]
+
+Each import runs in a fresh interpreter. 'eager' also imports eel and pexpect,
+which is what `import conger` cost before they were loaded on first use.
+"""
+import subprocess
+import sys
+import time
+
+MODES = {
+    'python only': 'pass',
+    'headless': 'import conger; conger.Root("bench", [conger.Text("hi")]).html()',
+    'eager': 'import conger, eel, pexpect; conger.Root("bench", [conger.Text("hi")]).html()',
+}
+
+
+def bench(code: str, iterations: int) -> float:
+    start = time.perf_counter()
+    for _ in range(iterations):
+        subprocess.run([sys.executable, '-c', code], check=True)
+    return (time.perf_counter() - start) / iterations
+
+
+def main(iterations: int = 20):
+    print(f'{iterations} fresh interpreters per mode')
+    for name, code in MODES.items():
+        print(f'{name:12} {bench(code, iterations) * 1000:8.1f} ms')
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
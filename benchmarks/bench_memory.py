@@ -0,0 +1,41 @@
+"""
+Memory footprint of large component trees.
+
+    python benchmarks/bench_memory.py [nodes]
+"""
+import sys
+import time
+import tracemalloc
+
+from conger import Root, VerticalStack, HorizontalStack, Text
+
+
+def build(nodes: int) -> Root:
+    rows = nodes // 2
+    return Root(children=[VerticalStack([
+        HorizontalStack((Text(f'host-{i}').font_color('#333333').font_size(14),))
+        .padding(4, 8, 4, 8)
+        .align_items_center()
+        for i in range(rows)
+    ])])
+
+
+def main(nodes: int = 100_000):
+    tracemalloc.start()
+    start = time.perf_counter()
+    root = build(nodes)
+    built = time.perf_counter()
+    tree_bytes = tracemalloc.get_traced_memory()[0]
+    html = root.html()
+    rendered = time.perf_counter()
+    total_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    print(f'nodes:            {nodes}')
+    print(f'build:            {built - start:.3f}s, {tree_bytes / nodes:.0f} B/node')
+    print(f'render:           {rendered - built:.3f}s, {len(html) / 1024 / 1024:.1f} MiB of HTML')
+    print(f'after render:     {(total_bytes - len(html)) / nodes:.0f} B/node (tree + render cache)')
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
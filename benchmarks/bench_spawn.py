@@ -0,0 +1,37 @@
+"""
+Spawn latency of delegator.run in its different modes.
+
+    python benchmarks/bench_spawn.py [iterations]
+"""
+import sys
+import time
+
+from conger import delegator
+
+MODES = {
+    'blocking (shell)': dict(block=True),
+    'pexpect': dict(block=False),
+    'stream (shell)': dict(block=False, stream=True),
+    'fast blocking': dict(block=True, fast=True),
+    'fast stream': dict(block=False, fast=True),
+    'fast + env override': dict(block=True, fast=True, env={'CONGER_BENCH': '1'}),
+}
+
+
+def bench(command: str, iterations: int, **kwargs) -> float:
+    start = time.perf_counter()
+    for _ in range(iterations):
+        c = delegator.run(command, **kwargs)
+        if not kwargs.get('block', True):
+            c.block()
+    return (time.perf_counter() - start) / iterations
+
+
+def main(iterations: int = 200):
+    print(f'{iterations} spawns of `true` per mode')
+    for name, kwargs in MODES.items():
+        print(f'{name:22} {bench("true", iterations, **kwargs) * 1000:7.3f} ms/spawn')
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -1,38 +1,104 @@
-from .base import BaseComponent
+from .base import BaseComponent, render_stats, get_component, find_component, dispatch
 from .components import *
-import eel
+from .bridge import updates, inputs, _eel
+from .pages import page_cache, page_key
+from .style import stylesheet
+
+def _mirror_input(serial: str, value: str):
+    """Records an input's value; the input re-renders with it from now on."""
+    inputs.push(serial, value)
+    component = find_component(serial)
+    if component is not None:
+        component.mark_dirty()
+
 
 def get_input_value(serial: str):
-    return eel.get_input_text(serial)()
+    value = inputs.get(serial)
+    if value is None:
+        value = _eel().get_input_text(serial)()
+        _mirror_input(serial, value)
+    return value
+
+
+def fetch_input_value(serial: str, timeout: float = 10.0):
+    """Returns a gevent AsyncResult for the input's value as the page has it now;
+    see InputMirror.fetch. The input re-renders with the value once it arrives."""
+    return inputs.fetch(serial, timeout, _mirror_input)
+
 
+# The set_* helpers patch the page and also update the component, so anything
+# rendered again later (such as a VirtualList row) shows the current state.
 
 def set_input_value(serial: str, text: str):
-    return eel.set_input_text(serial, text)
+    _mirror_input(serial, text)
+    updates.put(serial, 'value', text)
 
 
 def set_text(serial: str, text: str):
-    eel.set_p_text(serial, text)
+    component = find_component(serial)
+    if isinstance(component, Text):
+        component.text = text
+    updates.put(serial, 'text', text)
 
 
 def set_image_src(serial: str, src: str):
-    eel.set_image_src(serial, src)
+    component = find_component(serial)
+    if isinstance(component, Image):
+        component.src = src
+    updates.put(serial, 'src', src)
 
 
 def set_background(serial: str, color: str):
-    eel.set_background(serial, color)
+    component = find_component(serial)
+    if component is not None:
+        component.background(color)
+    updates.put(serial, 'background', color)
 
 
 def set_font_color(serial: str, color: str):
-    eel.set_text_color(serial, color)
+    component = find_component(serial)
+    if component is not None:
+        component.font_color(color)
+    updates.put(serial, 'color', color)
 
 
-def init(component: BaseComponent):
-    html = component.html()
-    with open('main.html', 'w') as f:
-        f.write(html)
-    print(html)
+_page = None
+# The component registry holds weak references, so the tree being served is kept alive here.
+_root = None
+
+
+def init(component: BaseComponent, cache: bool = True):
+    """Prepares the page for start(). The page is served from memory at /main.html;
+    with cache, a launch whose tree and styles match an earlier one reuses that
+    launch's HTML from the page cache instead of rendering."""
+    global _page, _root
+    key = page_key(component) if cache else None
+    page = page_cache.load(key) if cache else None
+    if page is None:
+        chunks = []
+        component.render(chunks.append)
+        page = ''.join(chunks)
+        if cache:
+            page_cache.store(key, page)
+    else:
+        stylesheet.mark_emitted()
+    _page = page
+    _root = component
+
+    eel = _eel()
+    eel._expose('conger_input', _mirror_input)
+    eel._expose('conger_dispatch', dispatch)
     eel.init('')
+    # main.html is not on disk for eel to scan, so register the page's functions here.
+    for name in JS_FUNCTIONS:
+        if name not in eel._js_functions:
+            eel._js_functions.append(name)
+            eel._mock_js_function(name)
+
+    import bottle
+    bottle.route('/main.html')(lambda: _page)
 
 
 def start():
-    eel.start('main.html')
+    updates.start()
+    _eel().start('main.html')
@@ -1,103 +1,254 @@
-from typing import Union, Callable, Iterable
-import eel
+import itertools
+from typing import Union, Callable, Iterable, Any
+from weakref import WeakValueDictionary
+from conger.style import stylesheet, Style
+
+
+class RenderStats:
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+
+    def reset(self):
+        self.hits = 0
+        self.misses = 0
+
+    def __repr__(self):
+        return f'<RenderStats hits={self.hits} misses={self.misses}>'
+
+
+render_stats = RenderStats()
+
+_default_style = Style({'overflow': 'hidden', 'transition': 'all 0.5s'})
+
+_ids = itertools.count()
+_registry: 'WeakValueDictionary[int, BaseComponent]' = WeakValueDictionary()
+
+
+def get_component(id: int) -> Union['BaseComponent', None]:
+    return _registry.get(id)
+
+
+def find_component(serial: str) -> Union['BaseComponent', None]:
+    """Looks up a component by the element id it renders with."""
+    if not serial.startswith('_') or not serial[1:].isdigit():
+        return None
+    return _registry.get(int(serial[1:]))
+
+
+def dispatch(serial: str, event: str, args: list):
+    component = find_component(serial)
+    if component is None:
+        return
+    handler = component._handler(event)
+    if handler is not None:
+        handler(*args)
+
+
+class _Recorder:
+    """Sink handed to a component's _render while it fills its cache.
+
+    Markup is passed straight on to the real sink and also kept as the
+    component's own segments. A child rendered into it records only a
+    reference to itself and writes to the real sink directly, so every chunk
+    is copied once however deep the tree is.
+    """
+    __slots__ = ('sink', 'segments')
+
+    def __init__(self, sink: Callable[[str], Any]):
+        self.sink = sink
+        self.segments = []
+
+    def __call__(self, chunk: str):
+        self.segments.append(chunk)
+        self.sink(chunk)
 
 
 class BaseComponent:
+    __slots__ = ('id', '_style', 'on_click_callback', '_parent', '_dirty', '_cache', '__weakref__')
+
     def __init__(self):
-        self.serial = '_0'
-        self._style = 'overflow: hidden; transition: all 0.5s; '
+        self.id = next(_ids)
+        _registry[self.id] = self
+        self._style = _default_style
         self.on_click_callback = None
+        self._parent: Union['BaseContainer', None] = None
+        self._dirty = True
+        self._cache = None
+
+    @property
+    def serial(self) -> str:
+        return f'_{self.id}'
+
+    def _add_style(self, prop: str, value: str):
+        self._style = self._style.with_property(prop, value)
+        self.mark_dirty()
+
+    def mark_dirty(self):
+        """Invalidates the cached HTML of this component and of every ancestor."""
+        node = self
+        while node is not None and not node._dirty:
+            node._dirty = True
+            node = node._parent
+
+    def _content_key(self):
+        return None
 
     def height(self, height: Union[str, int]) -> 'BaseComponent':
         if isinstance(height, int):
-            self._style += f'height: {height}px; '
+            self._add_style('height', f'{height}px')
         else:
-            self._style += f'height: {height}; '
+            self._add_style('height', height)
         return self
 
     def width(self, width: Union[str, int]) -> 'BaseComponent':
         if isinstance(width, int):
-            self._style += f'width: {width}px; flex: none; '
+            self._add_style('width', f'{width}px')
+            self._add_style('flex', 'none')
         else:
-            self._style += f'width: {width}; flex: none; '
+            self._add_style('width', width)
+            self._add_style('flex', 'none')
         return self
 
     def padding(self, t: int, r: int, b: int, l: int) -> 'BaseComponent':
-        self._style += f'padding: {t}px {r}px {b}px {l}px; '
+        self._add_style('padding', f'{t}px {r}px {b}px {l}px')
         return self
 
     def background(self, background: str) -> 'BaseComponent':
-        self._style += f'background: {background}; '
+        self._add_style('background', background)
         return self
 
     def font_color(self, color: str) -> 'BaseComponent':
-        self._style += f'color: {color}; '
+        self._add_style('color', color)
         return self
 
     def border(self, width: int, color: str) -> 'BaseComponent':
-        self._style += f'border: solid {width}px {color}; '
+        self._add_style('border', f'solid {width}px {color}')
         return self
 
     def margin(self, t: int, r: int, b: int, l: int):
-        self._style += f'margin: {t}px {r}px {b}px {l}px; '
+        self._add_style('margin', f'{t}px {r}px {b}px {l}px')
         return self
 
     def center_text(self):
-        self._style += f'text-align: center; '
+        self._add_style('text-align', 'center')
         return self
 
     def font_size(self, size: int):
-        self._style += f'font-size: {size}px; '
+        self._add_style('font-size', f'{size}px')
         return self
 
     def shadow(self, color: str):
-        self._style += f'box-shadow: 0px 5px 6px {color}4f; '
+        self._add_style('box-shadow', f'0px 5px 6px {color}4f')
         return self
 
     def rounded_corner(self, size: int):
-        self._style += f'border-radius: {size}px; '
+        self._add_style('border-radius', f'{size}px')
         return self
 
     def on_click(self, callback: Callable) -> 'BaseComponent':
         self.on_click_callback = callback
+        self.mark_dirty()
+
+        return self
+
+    def _class_name(self) -> str:
+        return stylesheet.class_for(self._style.css())
+
+    def _handler(self, event: str) -> Union[Callable, None]:
+        if event == 'click':
+            return self.on_click_callback
+        return None
+
+    def _click_attr(self) -> str:
+        if self.on_click_callback is None:
+            return ''
+        return f' onClick="eel.conger_dispatch(\'{self.serial}\', \'click\', [])"'
+
+    def render(self, write: Callable[[str], Any]):
+        if write.__class__ is _Recorder:
+            write.segments.append(self)
+            write = write.sink
+        key = (self.serial, self._style.css(), self._content_key())
+        if not self._dirty and self._cache is not None and self._cache[0] == key:
+            render_stats.hits += 1
+            # Own markup is replayed; children validate and replay their own caches.
+            if self._cache[2]:
+                stylesheet.use(self._cache[2])
+            for segment in self._cache[1]:
+                if segment.__class__ is str:
+                    write(segment)
+                else:
+                    segment.render(write)
+        else:
+            render_stats.misses += 1
+            recorder = _Recorder(write)
+            outer = stylesheet.open_frame()
+            try:
+                self._render(recorder)
+            finally:
+                classes = stylesheet.close_frame(outer)
+            self._cache = (key, tuple(recorder.segments), classes)
+            self._dirty = False
+
+    def _render(self, write: Callable[[str], Any]):
+        raise NotImplementedError
 
-        return self
+    def _digest(self, write: Callable[[str], Any]):
+        """Writes everything the rendered HTML depends on, without rendering. Also
+        registers the component's class with the stylesheet."""
+        write(f'{type(self).__qualname__} {self.id} {self._class_name()} {self._content_key()!r} '
+              f'{self.on_click_callback is not None}\n')
 
-    def html(self):
-        raise NotImplementedError
+    def html(self) -> str:
+        chunks = []
+        self.render(chunks.append)
+        return ''.join(chunks)
 
 
 class BaseContainer(BaseComponent):
+    __slots__ = ('children',)
+
     def __init__(self, children: Union[Iterable, None]):
         super().__init__()
+        if children is not None and not isinstance(children, (list, tuple)):
+            children = tuple(children)
         self.children: Iterable[BaseComponent] = children if children is not None else []
 
-    def html(self):
-        print(self.serial)
-        body = ''
+    def _content_key(self):
+        if self.children is None:
+            return None
+        return tuple(map(id, self.children))
+
+    def _render(self, write: Callable[[str], Any]):
         if self.children is None:
-            return body
-        c = tuple(self.children)
-        for i in range(c.__len__()):
-            child: BaseComponent = c[i]
-            child.serial = self.serial + '_' + str(i)
-            if hasattr(child, 'on_click_callback') and child.on_click_callback is not None:
-                eel._expose(child.serial + 'click', child.on_click_callback)
-            body += child.html()
-        return body
+            return
+        for child in self.children:
+            child._parent = self
+            child.render(write)
+
+    def _digest(self, write: Callable[[str], Any]):
+        # _content_key holds object ids, which differ between runs; use the children's digests instead.
+        children = self.children if self.children is not None else ()
+        write(f'{type(self).__qualname__} {self.id} {self._class_name()} {len(children)} '
+              f'{self.on_click_callback is not None}\n')
+        for child in children:
+            # On a page cache hit nothing is rendered, so link parents here.
+            child._parent = self
+            child._digest(write)
 
     def justify_center(self):
-        self._style += 'justify-content: center; '
+        self._add_style('justify-content', 'center')
         return self
 
     def justify_between(self):
-        self._style += 'justify-content: space-between; '
+        self._add_style('justify-content', 'space-between')
         return self
 
     def justify_end(self):
-        self._style += 'justify-content: end; '
+        self._add_style('justify-content', 'end')
         return self
 
     def align_items_center(self):
-        self._style += 'align-items: center; '
+        self._add_style('align-items', 'center')
         return self
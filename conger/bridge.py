@@ -0,0 +1,158 @@
+from collections import deque
+from threading import Lock
+import time
+from typing import Any, Callable, Deque, Dict, List, Tuple, Union
+
+
+def _eel():
+    """Imports eel on first use; it pulls in bottle and gevent, which headless
+    rendering does not need."""
+    import eel
+    return eel
+
+
+class UpdateQueue:
+    """Collects attribute patches for the page and sends them in batches.
+
+    Patches are merged per (serial, attribute), so only the last value written
+    between two flushes reaches the browser.
+
+    The page acknowledges every batch. While max_in_flight batches are
+    unacknowledged the browser is behind: flushes are skipped and patches keep
+    merging in Python until it catches up. A batch not acknowledged within
+    ack_timeout seconds (e.g. after a reload) no longer counts.
+    """
+
+    def __init__(self, interval: float = 0.016, max_in_flight: int = 2, ack_timeout: float = 1.0):
+        self.interval = interval
+        self.max_in_flight = max_in_flight
+        self.ack_timeout = ack_timeout
+        self.frames = 0
+        self.skipped = 0
+        self._pending: Dict[Tuple[str, str], Any] = {}
+        self._appends: Dict[Tuple[str, str], Deque[str]] = {}
+        self._before_flush: List[Callable[[], None]] = []
+        self._in_flight: Deque[float] = deque()
+        self._lock = Lock()
+        self._running = False
+
+    @property
+    def behind(self) -> bool:
+        """Whether the browser has not yet acknowledged the last max_in_flight batches."""
+        return len(self._in_flight) >= self.max_in_flight
+
+    def put(self, serial: str, attr: str, value: Any):
+        with self._lock:
+            self._pending[(serial, attr)] = value
+
+    def append(self, serial: str, attr: str, text: str, limit: Union[int, None] = None):
+        """Like put, but pieces of text are concatenated instead of replaced. With a
+        limit only the last `limit` pieces since the previous flush are sent."""
+        with self._lock:
+            pieces = self._appends.get((serial, attr))
+            if pieces is None:
+                pieces = self._appends[(serial, attr)] = deque(maxlen=limit)
+            pieces.append(text)
+
+    def discard(self, serial: str, attr: str):
+        with self._lock:
+            self._pending.pop((serial, attr), None)
+            self._appends.pop((serial, attr), None)
+
+    def before_flush(self, callback: Callable[[], None]):
+        """Runs callback once, right before the next batch is sent."""
+        with self._lock:
+            self._before_flush.append(callback)
+
+    def _ack(self, _=None):
+        with self._lock:
+            if self._in_flight:
+                self._in_flight.popleft()
+
+    def flush(self, force: bool = False):
+        with self._lock:
+            now = time.monotonic()
+            while self._in_flight and now - self._in_flight[0] > self.ack_timeout:
+                self._in_flight.popleft()
+            if self.behind and not force:
+                self.skipped += 1
+                return
+            hooks, self._before_flush = self._before_flush, []
+        for hook in hooks:
+            hook()
+        with self._lock:
+            if not self._pending and not self._appends:
+                return
+            pending, self._pending = self._pending, {}
+            appends, self._appends = self._appends, {}
+            self.frames += 1
+            self._in_flight.append(now)
+        patches = [[serial, attr, value] for (serial, attr), value in pending.items()]
+        patches.extend([serial, attr, ''.join(pieces)] for (serial, attr), pieces in appends.items())
+        _eel().apply_patches(patches)(self._ack)
+
+    def _loop(self):
+        while self._running:
+            self.flush()
+            _eel().sleep(self.interval)
+
+    def start(self):
+        if not self._running:
+            self._running = True
+            _eel().spawn(self._loop)
+
+    def stop(self):
+        self._running = False
+        self.flush(force=True)
+
+
+updates = UpdateQueue()
+
+
+class InputMirror:
+    """Python-side copy of every input's value, kept current by the browser."""
+
+    def __init__(self):
+        self._values: Dict[str, str] = {}
+
+    def push(self, serial: str, value: str):
+        self._values[serial] = value
+
+    def get(self, serial: str) -> Union[str, None]:
+        return self._values.get(serial)
+
+    def fetch(self, serial: str, timeout: float = 10.0,
+              record: Union[Callable[[str, str], None], None] = None) -> 'gevent.event.AsyncResult':
+        """Asks the page for an input's current value without blocking.
+
+        The result is resolved on the gevent hub, so wait on it with
+        result.get() from a greenlet (an eel callback or a spawned task). It
+        fails with RuntimeError when the page reports an error and with
+        TimeoutError when no answer arrives within timeout seconds. The value is
+        handed to record (push by default) before the result is set.
+        """
+        import gevent
+        from gevent.event import AsyncResult
+        result = AsyncResult()
+        record = record or self.push
+
+        def done(value):
+            if not result.ready():
+                record(serial, value)
+                result.set(value)
+
+        def failed(error, stack=None):
+            if not result.ready():
+                result.set_exception(RuntimeError(f'get_input_text({serial!r}) failed: {error}'))
+
+        def expired():
+            if not result.ready():
+                result.set_exception(TimeoutError(f'get_input_text({serial!r}) timed out after {timeout}s'))
+
+        _eel().get_input_text(serial)(done, failed)
+        gevent.spawn_later(timeout, expired)
+        return result
+
+
+inputs = InputMirror()
+
@@ -1,20 +1,50 @@
+import html
 import re
+from collections import deque
+from threading import Lock
 
-import eel
-from typing import Iterable, Union, List, Callable
+from typing import Iterable, Union, List, Callable, Any, Dict, Sequence
 from conger import BaseComponent
 from conger.base import BaseContainer
+from conger.bridge import inputs, updates
+from conger.style import stylesheet, Style
+
+
+# Functions the page exposes with eel.expose, for conger.init to register when
+# serving a cached page that eel never scans.
+JS_FUNCTIONS = ('get_input_text', 'set_input_text', 'set_image_src', 'set_p_text', 'set_background',
+                'set_text_color', 'apply_patches')
 
 
 class Root(BaseContainer):
+    __slots__ = ('title',)
+
     def __init__(self, title: str = 'Conger', children: Union[Iterable[BaseComponent], None] = None):
         super().__init__(children)
-        self.children: List[BaseComponent] = children if children is not None else []
         self.title = title
 
-    def html(self):
-        body = super().html()
-        html = f"""<!DOCTYPE html>
+    def _content_key(self):
+        return self.title, super()._content_key()
+
+    def _digest(self, write: Callable[[str], Any]):
+        write(f'{self.title!r}\n')
+        super()._digest(write)
+
+    def render(self, write: Callable[[str], Any]):
+        # The head lists the styles of everything below, so the page itself is
+        # rebuilt on every render; only the subtrees come from their caches.
+        self._render(write)
+
+    def _render(self, write: Callable[[str], Any]):
+        body = []
+        # The head lists only the classes this page uses, collected while the body renders.
+        stylesheet.begin_pass()
+        try:
+            super()._render(body.append)
+            body_class = self._class_name()
+        finally:
+            css = stylesheet.end_pass()
+        write(f"""<!DOCTYPE html>
 <html lang="zh-cn">
 <head>
     <meta charset="UTF-8">
@@ -27,6 +57,7 @@ class Root(BaseContainer):
         eel.expose(set_p_text);
         eel.expose(set_background);
         eel.expose(set_text_color);
+        eel.expose(apply_patches);
         function get_input_text(id){' {'}
             return document.getElementById(id).value
         {'}'}
@@ -45,57 +76,263 @@ class Root(BaseContainer):
         function set_text_color(id, value) {' {'}
             document.getElementById(id).style.color = value
         {'}'}
+        const conger_timers = {'{}'};
+        function conger_debounce(key, wait, callback) {' {'}
+            clearTimeout(conger_timers[key])
+            conger_timers[key] = setTimeout(callback, wait)
+        {'}'}
+        const conger_last = {'{}'};
+        function conger_throttle(key, wait, callback) {' {'}
+            const now = Date.now()
+            const elapsed = now - (conger_last[key] || 0)
+            clearTimeout(conger_timers[key])
+            if (elapsed >= wait) {' {'}
+                conger_last[key] = now
+                callback()
+            {'}'} else {' {'}
+                conger_timers[key] = setTimeout(() => {' {'}
+                    conger_last[key] = Date.now()
+                    callback()
+                {'}'}, wait - elapsed)
+            {'}'}
+        {'}'}
+        function conger_scroll(element) {' {'}
+            const send = () => eel.conger_dispatch(element.id, 'scroll', [element.scrollTop, element.clientHeight])
+            conger_throttle(element.id + 'scroll', 50, send)
+        {'}'}
+        function conger_window(element, [drop_front, drop_back, before, after, top]) {' {'}
+            for (let i = 0; i < drop_front; i++) element.firstElementChild.remove()
+            for (let i = 0; i < drop_back; i++) element.lastElementChild.remove()
+            element.insertAdjacentHTML('afterbegin', before)
+            element.insertAdjacentHTML('beforeend', after)
+            element.style.top = top
+        {'}'}
+        function conger_append(element, html) {' {'}
+            const bottom = element.scrollTop + element.clientHeight >= element.scrollHeight - 4
+            element.insertAdjacentHTML('beforeend', html)
+            const extra = element.childElementCount - Number(element.dataset.maxLines)
+            for (let i = 0; i < extra; i++) element.firstElementChild.remove()
+            if (element.dataset.autoscroll === 'true' && bottom) element.scrollTop = element.scrollHeight
+        {'}'}
+        function apply_patches(patches) {' {'}
+            for (const [id, attr, value] of patches) {' {'}
+                const element = document.getElementById(id)
+                if (element === null) continue
+                if (attr === 'text') element.innerHTML = value
+                else if (attr === 'src') element.src = value
+                else if (attr === 'value') element.value = value
+                else if (attr === 'css') element.insertAdjacentText('beforeend', value)
+                else if (attr === 'append') conger_append(element, value)
+                else if (attr === 'window') conger_window(element, value)
+                else element.style[attr] = value
+            {'}'}
+            return patches.length
+        {'}'}
     </script>
+    <style id="conger-styles">
+{css}
+    </style>
 </head>
-<body style='{self._style}'>
-{body}
+<body class='{body_class}'>
+""")
+        for chunk in body:
+            write(chunk)
+        write("""
 </body>
 </html>
-"""
-        return html
+""")
 
 
 class Container(BaseContainer):
-    def html(self):
-        body = super().html()
-        html = f"<div style='{self._style}' onClick='eel.{self.serial}click()'>\n{body}\n</div>\n"
-        return html
+    __slots__ = ()
+
+    def _render(self, write: Callable[[str], Any]):
+        write(f"<div class='{self._class_name()}'{self._click_attr()}>\n")
+        super()._render(write)
+        write("\n</div>\n")
 
     def __init__(self, children: Union[Iterable[BaseComponent], None]):
         super().__init__(children)
 
 
+_flex_style = Style({'display': 'flex'})
+
+
 class HorizontalStack(Container):
+    __slots__ = ()
+
     def __init__(self, children: Union[Iterable[BaseComponent], None] = None):
         super().__init__(children)
-        self._style = 'display: flex; '
+        self._style = _flex_style
 
 
 class VerticalStack(Container):
+    __slots__ = ()
+
     def __init__(self, children: Union[Iterable, None] = None):
         super().__init__(children)
 
 
+_virtual_style = Style({'overflow-y': 'auto', 'transition': 'all 0.5s'})
+
+
+class VirtualList(BaseComponent):
+    """Scrolling list that keeps only the rows in or near the viewport in the DOM.
+
+    Rows are components, or callables returning one (such as TaskWidget), and
+    are built the first time they scroll into view. Every row is row_height
+    pixels tall. On scroll the browser reports its position; once per frame
+    the rows entering the window are rendered in Python and the ones leaving
+    it are removed, while rows that stay keep their DOM (and any live state).
+    The work per scroll depends on the height of the list, not on the number
+    of rows. Rows scrolling back in are rendered from the component tree, which
+    set_text, set_background and the other set_* helpers keep current.
+    """
+    __slots__ = ('rows', 'row_height', 'overscan', '_built', '_window', '_sent', '_scheduled')
+
+    def __init__(self, rows: Sequence[Union[BaseComponent, Callable[[], BaseComponent]]], row_height: int,
+                 height: Union[int, str] = 400, overscan: int = 5):
+        super().__init__()
+        self.rows = rows
+        self.row_height = row_height
+        self.overscan = overscan
+        self._built: Dict[int, BaseComponent] = {}
+        self._style = _virtual_style
+        self.height(height)
+        visible = height // row_height if isinstance(height, int) else 20
+        self._window = (0, min(visible + overscan, len(rows)))
+        # The window the browser has (or will have after the next flush).
+        self._sent = self._window
+        self._scheduled = False
+
+    def _row(self, index: int) -> BaseComponent:
+        row = self._built.get(index)
+        if row is None:
+            row = self.rows[index]
+            if not isinstance(row, BaseComponent):
+                row = row()
+            row._parent = self
+            self._built[index] = row
+        return row
+
+    def _render_rows(self, first: int, last: int, write: Callable[[str], Any]):
+        row_class = stylesheet.class_for(f'height: {self.row_height}px; overflow: hidden; ')
+        for index in range(first, last):
+            write(f"<div class='{row_class}'>")
+            self._row(index).render(write)
+            write('</div>')
+
+    def _rows_html(self, first: int, last: int) -> str:
+        chunks = []
+        self._render_rows(first, last, chunks.append)
+        return ''.join(chunks)
+
+    def _content_key(self):
+        return len(self.rows), self.row_height, self._window
+
+    def _digest(self, write: Callable[[str], Any]):
+        super()._digest(write)
+        for index in range(*self._window):
+            self._row(index)._digest(write)
+        self._sent = self._window
+
+    def _render(self, write: Callable[[str], Any]):
+        first = self._window[0]
+        self._sent = self._window
+        write(f"<div id='{self.serial}' class='{self._class_name()}'{self._click_attr()}"
+              f" onscroll='conger_scroll(this)'>")
+        write(f"<div style='position: relative; height: {len(self.rows) * self.row_height}px'>")
+        write(f"<div id='{self.serial}w' style='position: absolute; left: 0; right: 0; "
+              f"top: {first * self.row_height}px'>")
+        self._render_rows(*self._window, write)
+        write('</div></div></div>\n')
+
+    def _handler(self, event: str) -> Union[Callable, None]:
+        if event == 'scroll':
+            return self._on_scroll
+        return super()._handler(event)
+
+    def _on_scroll(self, scroll_top: float, client_height: float):
+        first = max(int(scroll_top) // self.row_height - self.overscan, 0)
+        last = min(-(-int(scroll_top + client_height) // self.row_height) + self.overscan, len(self.rows))
+        self._window = (first, last)
+        if not self._scheduled and self._window != self._sent:
+            self._scheduled = True
+            updates.before_flush(self._send_window)
+
+    def _send_window(self):
+        # Runs once per sent frame, so the patch is always relative to what the browser has.
+        self._scheduled = False
+        (sent_first, sent_last), (first, last) = self._sent, self._window
+        if (sent_first, sent_last) == (first, last):
+            return
+        self._sent = self._window
+        if first >= sent_last or last <= sent_first:
+            drop_front, drop_back = sent_last - sent_first, 0
+            before, after = '', self._rows_html(first, last)
+        else:
+            drop_front, drop_back = max(first - sent_first, 0), max(sent_last - last, 0)
+            before = self._rows_html(first, sent_first) if first < sent_first else ''
+            after = self._rows_html(sent_last, last) if last > sent_last else ''
+        css = stylesheet.take_new()
+        if css:
+            updates.append('conger-styles', 'css', '\n' + css)
+        updates.put(f'{self.serial}w', 'window', [drop_front, drop_back, before, after, f'{first * self.row_height}px'])
+
+
 class Button(BaseContainer):
-    def html(self):
-        body = super().html()
-        html = f'<Button id="{self.serial}" style="{self._style}user-select: none; outline: none;" onClick="eel.{self.serial}click()">{body}</Button>'
-        return html
+    __slots__ = ()
+
+    def _class_name(self) -> str:
+        return stylesheet.class_for(self._style.css() + 'user-select: none; outline: none; ')
+
+    def _render(self, write: Callable[[str], Any]):
+        write(f'<Button id="{self.serial}" class="{self._class_name()}"{self._click_attr()}>')
+        super()._render(write)
+        write('</Button>')
 
     def __init__(self, children: Union[Iterable[BaseComponent], None] = None):
         super().__init__(children)
 
 
 class Input(BaseComponent):
-    def html(self):
-        if self._on_change_callback is not None:
-            eel._expose(self.serial + 'change', self._on_change_callback)
-        if self._on_keydown_callback is not None:
-            eel._expose(self.serial + 'keydown', self._on_keydown_callback)
-        html = f'<input id="{self.serial}" style="{self._style}" ' \
-               f'placeholder="{self.place_holder_value}" value="{self.default_value}"' \
-               f' onchange="eel.{self.serial}change(this.value)" onClick="eel.{self.serial}click()" onkeydown="eel.{self.serial}keydown()">'
-        return html
+    __slots__ = ('place_holder_value', 'default_value', '_on_change_callback', '_on_keydown_callback',
+                 '_on_change_options', '_on_keydown_options')
+
+    def _render(self, write: Callable[[str], Any]):
+        # Re-renders (e.g. a VirtualList row scrolling back in) show what the user typed.
+        value = inputs.get(self.serial)
+        if value is None:
+            value = self.default_value
+            inputs.push(self.serial, value)
+        on_change = self._handler_js('change', self._on_change_callback, self._on_change_options)
+        if on_change:
+            on_change = '; ' + on_change
+        on_keydown = self._handler_js('keydown', self._on_keydown_callback, self._on_keydown_options)
+        tag = f'<input id="{self.serial}" class="{self._class_name()}" ' \
+              f'placeholder="{self.place_holder_value}" value="{html.escape(value)}"' \
+              f' oninput="conger_debounce(this.id + \'input\', 50, () => eel.conger_input(this.id, this.value))"' \
+              f' onchange="eel.conger_input(this.id, this.value){on_change}"{self._click_attr()}'
+        if on_keydown:
+            tag += f' onkeydown="{on_keydown}"'
+        write(tag + '>')
+
+    def _digest(self, write: Callable[[str], Any]):
+        super()._digest(write)
+        # Seed the mirror as _render does, since a page cache hit skips rendering.
+        if inputs.get(self.serial) is None:
+            inputs.push(self.serial, self.default_value)
+
+    def _handler_js(self, event: str, callback: Union[Callable, None], options: tuple) -> str:
+        if callback is None:
+            return ''
+        debounce, throttle, send_value = options
+        call = f"eel.conger_dispatch('{self.serial}', '{event}', [{'this.value' if send_value else ''}])"
+        if debounce:
+            return f"conger_debounce(this.id + '{event}', {debounce}, () => {call})"
+        if throttle:
+            return f"conger_throttle(this.id + '{event}', {throttle}, () => {call})"
+        return call
 
     def __init__(self, place_holder: str = '', default: str = ''):
         super().__init__()
@@ -103,22 +340,55 @@ class Input(BaseComponent):
         self.default_value = default
         self._on_change_callback = None
         self._on_keydown_callback = None
+        self._on_change_options = (None, None, True)
+        self._on_keydown_options = (None, None, False)
+
+    def _handler(self, event: str) -> Union[Callable, None]:
+        if event == 'change':
+            return self._on_change_callback
+        if event == 'keydown':
+            return self._on_keydown_callback
+        return super()._handler(event)
+
+    def _content_key(self):
+        return (self.place_holder_value, self.default_value,
+                self._on_change_callback is not None, self._on_change_options,
+                self._on_keydown_callback is not None, self._on_keydown_options)
 
     def place_holder(self, s: str) -> 'Input':
         self.place_holder_value = s
+        self.mark_dirty()
         return self
 
     def set_default_value(self, s: str) -> 'Input':
         self.default_value = s
+        inputs.push(self.serial, s)
+        self.mark_dirty()
         return self
 
-    def on_change(self, callback: Callable) -> 'Input':
+    def on_change(self, callback: Callable, debounce: Union[int, None] = None,
+                  throttle: Union[int, None] = None, send_value: bool = True) -> 'Input':
+        """
+        debounce/throttle are in milliseconds and are applied in the browser,
+        so suppressed events never reach Python. With send_value the callback
+        receives the input's current value.
+        """
+        if debounce and throttle:
+            raise ValueError('debounce and throttle are mutually exclusive')
         self._on_change_callback = callback
+        self._on_change_options = (debounce, throttle, send_value)
+        self.mark_dirty()
 
         return self
 
-    def on_keydown(self, callback: Callable) -> 'Input':
+    def on_keydown(self, callback: Callable, debounce: Union[int, None] = None,
+                   throttle: Union[int, None] = None, send_value: bool = False) -> 'Input':
+        """See on_change."""
+        if debounce and throttle:
+            raise ValueError('debounce and throttle are mutually exclusive')
         self._on_keydown_callback = callback
+        self._on_keydown_options = (debounce, throttle, send_value)
+        self.mark_dirty()
 
         return self
 
@@ -128,30 +398,170 @@ class Input(BaseComponent):
 
 
 class Text(BaseComponent):
+    __slots__ = ('_text',)
+
     def __init__(self, text: str):
         super().__init__()
-        self.text = text
+        self._text = text
+
+    @property
+    def text(self) -> str:
+        return self._text
+
+    @text.setter
+    def text(self, text: str):
+        self._text = text
+        self.mark_dirty()
 
-    def html(self):
-        html = f'<p id="{self.serial}" onClick="eel.{self.serial}click()" style="{self._style}">{self.text}</p>'
-        return html
+    def _content_key(self):
+        return self._text
+
+    def _render(self, write: Callable[[str], Any]):
+        write(f'<p id="{self.serial}"{self._click_attr()} class="{self._class_name()}">{self.text}</p>')
 
     def font_size(self, size: int):
-        self._style += f'font-size: {size}px; '
+        self._add_style('font-size', f'{size}px')
         return self
 
 
+_log_style = Style({'overflow-y': 'auto', 'white-space': 'pre-wrap', 'font-family': 'monospace',
+                    'font-size': '12px', 'transition': 'all 0.5s'})
+_stderr_style = Style({'color': '#FF8A80'})
+
+
+class LogView(BaseComponent):
+    """Console-like view that only ever appends lines.
+
+    New lines are escaped and queued as an append patch, so each frame sends
+    only the lines written since the previous one. The browser keeps at most
+    max_lines lines and, with autoscroll, follows the end unless the user has
+    scrolled up.
+
+    At most `budget` bytes of lines are sent per frame. Past that, the rest of
+    the frame's lines are held back: the last tail_lines of them are sent at
+    the start of the next frame behind a line saying how many were dropped in
+    between. Since frames are not sent while the browser is behind, a fast
+    task costs a bounded amount of memory and bandwidth at any output rate.
+    """
+    __slots__ = ('max_lines', 'autoscroll', 'budget', '_lines', '_count', '_lock', '_frame', '_used',
+                 '_overflow', '_dropped')
+
+    def __init__(self, max_lines: int = 1000, autoscroll: bool = True, height: Union[int, str] = 300,
+                 budget: int = 16384, tail_lines: int = 20):
+        super().__init__()
+        self.max_lines = max_lines
+        self.autoscroll = autoscroll
+        self.budget = budget
+        self._lines = deque(maxlen=max_lines)
+        self._count = 0
+        self._lock = Lock()
+        self._frame = -1
+        self._used = 0
+        self._overflow = deque(maxlen=tail_lines)
+        self._dropped = 0
+        self._style = _log_style
+        self.height(height)
+
+    @staticmethod
+    def _line_html(stream: str, line: str) -> str:
+        if stream == 'stderr':
+            return f"<div class='{stylesheet.class_for(_stderr_style.css())}'>{html.escape(line)}</div>"
+        return f'<div>{html.escape(line)}</div>'
+
+    def write(self, stream: str, line: str):
+        """Appends a line; matches Process output callbacks, so it can be passed as one."""
+        line_html = self._line_html(stream, line)
+        self.mark_dirty()
+        # Called on the supervisor thread while the UI thread may be rendering.
+        with self._lock:
+            self._lines.append(line_html)
+            self._count += 1
+            if self._frame != updates.frames:
+                self._frame = updates.frames
+                self._used = 0
+            if not self._overflow and self._used + len(line_html) <= self.budget:
+                self._used += len(line_html)
+                updates.append(self.serial, 'append', line_html, self.max_lines)
+                return
+            if not self._overflow and not self._dropped:
+                updates.before_flush(self._flush_overflow)
+            if len(self._overflow) == self._overflow.maxlen:
+                self._dropped += 1
+            self._overflow.append(line_html)
+
+    def _flush_overflow(self):
+        with self._lock:
+            overflow, self._overflow = list(self._overflow), deque(maxlen=self._overflow.maxlen)
+            dropped, self._dropped = self._dropped, 0
+        if dropped:
+            updates.append(self.serial, 'append', f'<div>… 已省略 {dropped} 行 …</div>', self.max_lines)
+        for line_html in overflow:
+            updates.append(self.serial, 'append', line_html, self.max_lines)
+
+    def append(self, line: str) -> 'LogView':
+        self.write('stdout', line)
+        return self
+
+    def clear(self) -> 'LogView':
+        self.mark_dirty()
+        with self._lock:
+            self._lines.clear()
+            self._count += 1
+            self._overflow.clear()
+            self._dropped = 0
+        updates.discard(self.serial, 'append')
+        updates.put(self.serial, 'text', '')
+        return self
+
+    def attach(self, process) -> 'LogView':
+        """Shows the buffered output of a task_dispatcher.Process and follows it."""
+        for stream, line in process.output.tail(self.max_lines):
+            self.write(stream, line)
+        process.on_output(self.write)
+        return self
+
+    def _snapshot(self) -> List[str]:
+        with self._lock:
+            return list(self._lines)
+
+    def _content_key(self):
+        return self._count, self.max_lines, self.autoscroll
+
+    def _digest(self, write: Callable[[str], Any]):
+        super()._digest(write)
+        for line_html in self._snapshot():
+            write(line_html)
+
+    def _render(self, write: Callable[[str], Any]):
+        stylesheet.class_for(_stderr_style.css())
+        write(f'<div id="{self.serial}" class="{self._class_name()}"{self._click_attr()} '
+              f'data-max-lines="{self.max_lines}" data-autoscroll="{str(self.autoscroll).lower()}">')
+        for line_html in self._snapshot():
+            write(line_html)
+        write('</div>')
+
+
 class Image(BaseComponent):
-    def html(self):
-        html = f'<img id="{self.serial}" onClick="eel.{self.serial}click()" src="{self.src}" style="{self._style}"/>'
-        return html
+    __slots__ = ('_src',)
+
+    def _render(self, write: Callable[[str], Any]):
+        write(f'<img id="{self.serial}"{self._click_attr()} src="{self.src}" class="{self._class_name()}"/>')
 
     def __init__(self, src: str):
         super().__init__()
-        self.src = src
+        self._src = src
+
+    @property
+    def src(self) -> str:
+        return self._src
 
+    @src.setter
     def src(self, src: str):
-        self.src = src
+        self._src = src
+        self.mark_dirty()
+
+    def _content_key(self):
+        return self._src
 
 
 def style(stylesheet: str, override=True):
@@ -161,13 +571,14 @@ def style(stylesheet: str, override=True):
     line_pattern = re.compile(r'[A-Za-z\-]*\s*:\s*[^;]*;$', flags=re.RegexFlag.MULTILINE)
     css_content = css_pattern.search(stylesheet).group(4)
     lines = line_pattern.findall(css_content)
-    inline = ' '.join(lines)
+    inline = Style.parse(' '.join(lines))
 
     def decorator(f: Callable[[], BaseComponent]):
         component = f()
         if override:
-            component._style += inline
+            component._style = component._style.merged(inline)
         else:
             component._style = inline
+        component.mark_dirty()
         return lambda: component
     return decorator
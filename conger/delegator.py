@@ -1,14 +1,27 @@
+import asyncio
+import codecs
 import os
+import re
 import subprocess
 import shlex
 import signal
 import sys
 import locale
 import errno
+import functools
+import shutil
+import mmap
+import selectors
+import tempfile
+
+
+def _pexpect():
+    """Imports pexpect the first time a command needs it."""
+    import pexpect
+    import pexpect.popen_spawn
+    pexpect.EOF.__module__ = "pexpect.exceptions"
+    return pexpect
 
-from pexpect.popen_spawn import PopenSpawn
-import pexpect
-pexpect.EOF.__module__ = "pexpect.exceptions"
 
 # Include `unicode` in STR_TYPES for Python 2.X
 try:
@@ -17,6 +30,55 @@ except NameError:
     STR_TYPES = (str,)
 
 TIMEOUT = 30
+SPILL_THRESHOLD = 8 * 1024 * 1024
+
+# Characters that need a shell; commands without them are exec'd directly in fast mode.
+SHELL_CHARS = frozenset("|&;<>()$`\\*?[]#~{}!\n")
+
+# Set by freeze_environ(); fast spawns otherwise build on the live os.environ.
+_environ = None
+
+
+def freeze_environ():
+    """Caches a copy of os.environ for fast spawns that override variables, which
+    saves copying the live environment on every spawn. Later changes to os.environ
+    are not seen until refresh_environ() or another freeze_environ()."""
+    global _environ
+    _environ = os.environ.copy()
+
+
+def refresh_environ():
+    """Drops the cached environment; fast spawns see os.environ again."""
+    global _environ
+    _environ = None
+
+
+def environ_snapshot():
+    """The environment fast spawns apply overrides to: the frozen copy, or os.environ."""
+    return _environ if _environ is not None else os.environ
+
+
+@functools.lru_cache(maxsize=256)
+def _which(name, path):
+    return shutil.which(name, path=path)
+
+
+def _fast_argv(command):
+    """Returns an argv list for command, or None if it needs a shell."""
+    if isinstance(command, STR_TYPES):
+        if SHELL_CHARS.intersection(command):
+            return None
+        argv = shlex.split(command)
+        if not argv or "=" in argv[0]:
+            return None
+    else:
+        argv = list(command)
+    if os.path.dirname(argv[0]):
+        return argv
+    executable = _which(argv[0], os.environ.get("PATH"))
+    if executable is None:
+        return None
+    return [executable] + argv[1:]
 
 
 def pid_exists(pid):
@@ -47,6 +109,87 @@ def pid_exists(pid):
         return True
 
 
+class Capture(object):
+    """Captured output that moves to a temporary file once it grows past
+    ``threshold`` bytes. Spilled output is accessed through mmap, so tail(),
+    slicing and search() work without loading it into memory."""
+
+    def __init__(self, threshold=SPILL_THRESHOLD):
+        self.threshold = threshold
+        self._buffer = bytearray()
+        self._file = None
+        self._map = None
+        self._size = 0
+
+    def __repr__(self):
+        return "<Capture {} bytes{}>".format(self._size, " spilled" if self.spilled else "")
+
+    @property
+    def spilled(self):
+        return self._file is not None
+
+    def __len__(self):
+        return self._size
+
+    def write(self, data):
+        if self._file is None:
+            self._buffer += data
+            if len(self._buffer) > self.threshold:
+                self._file = tempfile.TemporaryFile()
+                self._file.write(self._buffer)
+                self._buffer = bytearray()
+        else:
+            self._file.write(data)
+        self._size += len(data)
+
+    def _view(self):
+        if self._file is None:
+            return self._buffer
+        if self._map is None or len(self._map) != self._size:
+            self._file.flush()
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._map
+
+    def __getitem__(self, key):
+        """Indexing returns an int and slicing returns bytes, as with bytes."""
+        if isinstance(key, slice):
+            return bytes(self._view()[key])
+        if key < 0:
+            key += self._size
+        if not 0 <= key < self._size:
+            raise IndexError("capture index out of range")
+        return self._view()[key]
+
+    def tail(self, n=10):
+        """Returns the last ``n`` lines as bytes."""
+        view = self._view()
+        end = self._size
+        if end and view[end - 1:end] == b"\n":
+            end -= 1
+        start = end
+        for _ in range(n):
+            start = view.rfind(b"\n", 0, start)
+            if start < 0:
+                break
+        return bytes(view[start + 1:self._size])
+
+    def search(self, pattern, flags=0):
+        """Searches the captured bytes for the given (bytes) regex."""
+        return re.compile(pattern, flags).search(self._view())
+
+    def finditer(self, pattern, flags=0):
+        return re.compile(pattern, flags).finditer(self._view())
+
+    def text(self, encoding="utf-8"):
+        """Decodes the whole capture. This loads it into memory."""
+        return bytes(self._view()).decode(encoding, errors="replace")
+
+    def close(self):
+        self._map = None
+        if self._file is not None:
+            self._file.close()
+
+
 class Command(object):
     def __init__(self, cmd, timeout=TIMEOUT):
         super(Command, self).__init__()
@@ -57,6 +200,11 @@ class Command(object):
         self.was_run = False
         self.__out = None
         self.__err = None
+        self._upstream = []
+        self._binary = False
+        self._spill = None
+        self.out_capture = None
+        self.err_capture = None
 
     def __repr__(self):
         return "<Command {!r}>".format(self.cmd)
@@ -92,7 +240,9 @@ class Command(object):
 
     @property
     def _uses_pexpect(self):
-        return isinstance(self.subprocess, PopenSpawn)
+        # Nothing can be a PopenSpawn before pexpect has been imported.
+        popen_spawn = sys.modules.get("pexpect.popen_spawn")
+        return popen_spawn is not None and isinstance(self.subprocess, popen_spawn.PopenSpawn)
 
     @property
     def std_out(self):
@@ -104,19 +254,21 @@ class Command(object):
 
     @property
     def _pexpect_out(self):
-        if self.subprocess.encoding:
-            result = ""
-        else:
-            result = b""
+        parts = []
 
         if self.subprocess.before:
-            result += self.subprocess.before
+            parts.append(self.subprocess.before)
 
-        if self.subprocess.after and self.subprocess.after is not pexpect.EOF:
-            result += self.subprocess.after
+        if self.subprocess.after and self.subprocess.after is not _pexpect().EOF:
+            parts.append(self.subprocess.after)
 
-        result += self.subprocess.read()
-        return result
+        parts.append(self.subprocess.read())
+        return ("" if self.subprocess.encoding else b"").join(parts)
+
+    def _capture_text(self, capture):
+        if self._binary:
+            return capture[:]
+        return capture.text()
 
     @property
     def out(self):
@@ -124,7 +276,12 @@ class Command(object):
         if self.__out is not None:
             return self.__out
 
-        if self._uses_subprocess:
+        if self.out_capture is not None:
+            self.__out = self._capture_text(self.out_capture)
+        elif self._uses_subprocess and self._upstream:
+            # A direct chain: read stdout and stderr together while the stages finish.
+            self.block()
+        elif self._uses_subprocess:
             self.__out = self.std_out.read()
         else:
             self.__out = self._pexpect_out
@@ -141,7 +298,11 @@ class Command(object):
         if self.__err is not None:
             return self.__err
 
-        if self._uses_subprocess:
+        if self.err_capture is not None:
+            self.__err = self._capture_text(self.err_capture)
+        elif self._uses_subprocess and self._upstream:
+            self.block()
+        elif self._uses_subprocess:
             self.__err = self.std_err.read()
         else:
             self.__err = self._pexpect_out
@@ -174,15 +335,57 @@ class Command(object):
     def std_in(self):
         return self.subprocess.stdin
 
-    def run(self, block=True, binary=False, cwd=None, env=None):
-        """Runs the given command, with or without pexpect functionality enabled."""
+    def _fast_popen(self, binary, cwd, env):
+        popen_kwargs = {
+            "stdout": subprocess.PIPE,
+            "stderr": subprocess.PIPE,
+            # Leaving fds open and cwd unset lets subprocess use posix_spawn/vfork.
+            "close_fds": False,
+            "universal_newlines": self.blocking and not binary and self._spill is None,
+        }
+        if not self.blocking:
+            popen_kwargs["stdin"] = subprocess.PIPE
+            env = dict(env or {}, PYTHONUNBUFFERED="1")
+        if env:
+            popen_kwargs["env"] = dict(environ_snapshot(), **env)
+        if cwd:
+            popen_kwargs["cwd"] = cwd
+        argv = _fast_argv(self.cmd)
+        if argv is None:
+            return subprocess.Popen(self._popen_args, shell=True, **popen_kwargs)
+        return subprocess.Popen(argv, **popen_kwargs)
+
+    def run(self, block=True, binary=False, cwd=None, env=None, stream=False, spill=None, fast=False):
+        """Runs the given command, with or without pexpect functionality enabled.
+
+        With ``stream`` a non-blocking command is started without pexpect, leaving
+        its stdout and stderr pipes (in binary mode) for the caller to read.
+
+        With ``spill`` (a byte threshold) a blocking command captures its output
+        into ``out_capture``/``err_capture``, which move to a temporary file once
+        they grow past the threshold.
+
+        ``fast`` skips pexpect and, for commands without shell syntax, the shell.
+        Environment overrides are applied to os.environ (or to the snapshot
+        taken by ``freeze_environ``) and the child is started with posix_spawn
+        or vfork where the platform allows. Non-blocking fast commands behave like
+        ``stream`` ones.
+        """
         self.blocking = block
+        self._binary = binary
+        self._spill = spill if block else None
 
+        if fast:
+            s = self._fast_popen(binary, cwd, env)
         # Use subprocess.
-        if self.blocking:
+        elif self.blocking or stream:
             popen_kwargs = self._default_popen_kwargs.copy()
-            del popen_kwargs["stdin"]
-            popen_kwargs["universal_newlines"] = not binary
+            if stream:
+                popen_kwargs["universal_newlines"] = False
+                popen_kwargs["env"]["PYTHONUNBUFFERED"] = "1"
+            else:
+                del popen_kwargs["stdin"]
+                popen_kwargs["universal_newlines"] = not binary and self._spill is None
             if cwd:
                 popen_kwargs["cwd"] = cwd
             if env:
@@ -199,7 +402,7 @@ class Command(object):
                 pexpect_kwargs["env"].update(env)
             # Enable Python subprocesses to work with expect functionality.
             pexpect_kwargs["env"]["PYTHONUNBUFFERED"] = "1"
-            s = PopenSpawn(self._popen_args, **pexpect_kwargs)
+            s = _pexpect().popen_spawn.PopenSpawn(self._popen_args, **pexpect_kwargs)
         self.subprocess = s
         self.was_run = True
 
@@ -209,6 +412,7 @@ class Command(object):
         if self.blocking:
             raise RuntimeError("expect can only be used on non-blocking commands.")
 
+        pexpect = _pexpect()
         try:
             self.subprocess.expect(pattern=pattern, timeout=timeout)
         except pexpect.EOF:
@@ -241,13 +445,30 @@ class Command(object):
         """Blocks until process is complete."""
         if self._uses_subprocess:
             # consume stdout and stderr
-            if self.blocking:
+            if self.blocking and self._spill is not None:
+                if self.out_capture is None:
+                    self._drain_to_captures()
+                self.subprocess.wait()
+            elif self.blocking:
+                # Only direct chains honour the timeout; plain blocking runs never did.
+                timeout = self.timeout if self._upstream else None
                 try:
-                    stdout, stderr = self.subprocess.communicate()
-                    self.__out = stdout
-                    self.__err = stderr
+                    stdout, stderr = self.subprocess.communicate(timeout=timeout)
+                    if self.__out is None:
+                        self.__out = stdout
+                    if self.__err is None:
+                        self.__err = stderr
                 except ValueError:
                     pass  # Don't read from finished subprocesses.
+                except subprocess.TimeoutExpired:
+                    for process in self._upstream + [self.subprocess]:
+                        process.kill()
+                    self.subprocess.communicate()
+                    for upstream in self._upstream:
+                        upstream.wait()
+                    raise
+                for upstream in self._upstream:
+                    upstream.wait()
             else:
                 self.subprocess.stdin.close()
                 self.std_out.close()
@@ -261,6 +482,27 @@ class Command(object):
                 if self.subprocess.proc.stdout:
                     self.subprocess.proc.stdout.close()
 
+    def _drain_to_captures(self):
+        self.out_capture = Capture(self._spill)
+        self.err_capture = Capture(self._spill)
+        streams = {
+            self.std_out.fileno(): self.out_capture,
+            self.std_err.fileno(): self.err_capture,
+        }
+        with selectors.DefaultSelector() as selector:
+            for fd in streams:
+                selector.register(fd, selectors.EVENT_READ)
+            while streams:
+                for key, _ in selector.select():
+                    data = os.read(key.fd, 65536)
+                    if data:
+                        streams[key.fd].write(data)
+                    else:
+                        selector.unregister(key.fd)
+                        del streams[key.fd]
+        self.std_out.close()
+        self.std_err.close()
+
     def pipe(self, command, timeout=None, cwd=None):
         """Runs the current command and passes its output to the next
         given process.
@@ -285,6 +527,150 @@ class Command(object):
         return c
 
 
+class AsyncCommand(object):
+    """asyncio counterpart of a non-blocking Command.
+
+    Output (stdout and stderr merged, as with pexpect) is read through
+    asyncio.subprocess, so a single event loop can drive many commands.
+    """
+
+    def __init__(self, cmd, timeout=TIMEOUT):
+        super(AsyncCommand, self).__init__()
+        self.cmd = cmd
+        self.timeout = timeout
+        self.subprocess = None
+        self.was_run = False
+        self.before = None
+        self.after = None
+        self._binary = False
+        self._buffer = ""
+        self._decoder = None
+        self._eof = False
+
+    def __repr__(self):
+        return "<AsyncCommand {!r}>".format(self.cmd)
+
+    @property
+    def pid(self):
+        return self.subprocess.pid
+
+    @property
+    def return_code(self):
+        return self.subprocess.returncode
+
+    @property
+    def ok(self):
+        return self.return_code == 0
+
+    async def run(self, binary=False, cwd=None, env=None):
+        """Starts the command."""
+        popen_env = os.environ.copy()
+        if env:
+            popen_env.update(env)
+        popen_env["PYTHONUNBUFFERED"] = "1"
+        kwargs = {
+            "stdin": asyncio.subprocess.PIPE,
+            "stdout": asyncio.subprocess.PIPE,
+            "stderr": asyncio.subprocess.STDOUT,
+            "cwd": cwd,
+            "env": popen_env,
+        }
+        if isinstance(self.cmd, STR_TYPES):
+            self.subprocess = await asyncio.create_subprocess_shell(self.cmd, **kwargs)
+        else:
+            self.subprocess = await asyncio.create_subprocess_exec(*self.cmd, **kwargs)
+        self._binary = binary
+        self._buffer = b"" if binary else ""
+        if not binary:
+            self._decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        self.was_run = True
+
+    async def _read(self):
+        data = await self.subprocess.stdout.read(65536)
+        if not data:
+            self._eof = True
+        if not self._binary:
+            data = self._decoder.decode(data, self._eof)
+        self._buffer += data
+
+    def _timeout(self, timeout):
+        return self.timeout if timeout == -1 else timeout
+
+    async def expect(self, pattern, timeout=-1):
+        """Waits on the given pattern to appear in std_out and returns the match,
+        or None if the output ended first."""
+        regex = re.compile(pattern)
+
+        async def search():
+            while True:
+                match = regex.search(self._buffer)
+                if match:
+                    self.before = self._buffer[:match.start()]
+                    self.after = match.group()
+                    self._buffer = self._buffer[match.end():]
+                    return match
+                if self._eof:
+                    self.before, self.after = self._buffer, None
+                    self._buffer = self._buffer[:0]
+                    return None
+                await self._read()
+
+        return await asyncio.wait_for(search(), self._timeout(timeout))
+
+    async def send(self, s, end=os.linesep):
+        """Sends the given string to std_in."""
+        data = s + end
+        if not isinstance(data, bytes):
+            data = data.encode("utf-8")
+        self.subprocess.stdin.write(data)
+        await self.subprocess.stdin.drain()
+
+    def __aiter__(self):
+        return self._lines()
+
+    async def _lines(self):
+        newline = b"\n" if self._binary else "\n"
+        while True:
+            index = self._buffer.find(newline)
+            if index >= 0:
+                line, self._buffer = self._buffer[:index + 1], self._buffer[index + 1:]
+                yield line
+            elif self._eof:
+                if self._buffer:
+                    line, self._buffer = self._buffer, self._buffer[:0]
+                    yield line
+                return
+            else:
+                await self._read()
+
+    async def out(self):
+        """Reads the remaining output."""
+        while not self._eof:
+            await self._read()
+        result, self._buffer = self._buffer, self._buffer[:0]
+        return result
+
+    async def wait(self, timeout=None):
+        """Closes std_in and waits until the process is complete. Unread output
+        is drained into the buffer (still returned by out()), so a full pipe
+        cannot block the process."""
+        if self.subprocess.stdin and not self.subprocess.stdin.is_closing():
+            self.subprocess.stdin.close()
+
+        async def finish():
+            while not self._eof:
+                await self._read()
+            return await self.subprocess.wait()
+
+        return await asyncio.wait_for(finish(), timeout)
+
+    def terminate(self):
+        self.subprocess.terminate()
+
+    def kill(self):
+        self.subprocess.send_signal(signal.SIGINT)
+
+
 def _expand_args(command):
     """Parses command strings and returns a Popen-ready list."""
 
@@ -312,8 +698,52 @@ def _expand_args(command):
     return command
 
 
-def chain(command, timeout=TIMEOUT, cwd=None, env=None):
+def _direct_chain(commands, timeout, cwd, env, binary):
+    popen_env = os.environ.copy()
+    if env:
+        popen_env.update(env)
+    processes = []
+    stdin = None
+    for i, args in enumerate(commands):
+        last = i == len(commands) - 1
+        p = subprocess.Popen(
+            args,
+            stdin=stdin,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE if last else None,
+            cwd=cwd,
+            env=popen_env,
+            universal_newlines=last and not binary,
+        )
+        if stdin is not None:
+            # The next stage holds the read end now; dropping ours lets
+            # upstream stages see SIGPIPE if it exits early.
+            stdin.close()
+        stdin = p.stdout
+        processes.append(p)
+
+    c = Command(commands[-1], timeout=timeout)
+    c.subprocess = processes[-1]
+    c.blocking = True
+    c.was_run = True
+    c._upstream = processes[:-1]
+    return c
+
+
+def chain(command, timeout=TIMEOUT, cwd=None, env=None, direct=False, binary=False):
+    """Runs a ``|`` separated pipeline.
+
+    By default each stage runs to completion and its output is passed on to the
+    next one. With ``direct`` every stage's stdout is connected straight to the
+    next stage's stdin through an OS pipe: all stages run concurrently and the
+    data never passes through Python. Read the result from ``c.std_out`` to
+    stream it, or ``c.out`` to collect it; collecting (or ``c.block()``) waits
+    at most ``timeout`` seconds for the pipeline to finish, then kills every
+    stage and raises ``subprocess.TimeoutExpired``.
+    """
     commands = _expand_args(command)
+    if direct:
+        return _direct_chain(commands, timeout, cwd, env, binary)
     data = None
 
     for command in commands:
@@ -329,11 +759,18 @@ def chain(command, timeout=TIMEOUT, cwd=None, env=None):
     return c
 
 
-def run(command, block=True, binary=False, timeout=TIMEOUT, cwd=None, env=None):
+def run(command, block=True, binary=False, timeout=TIMEOUT, cwd=None, env=None, stream=False, spill=None,
+        fast=False):
     c = Command(command, timeout=timeout)
-    c.run(block=block, binary=binary, cwd=cwd, env=env)
+    c.run(block=block, binary=binary, cwd=cwd, env=env, stream=stream, spill=spill, fast=fast)
 
     if block:
         c.block()
 
     return c
+
+
+async def arun(command, binary=False, timeout=TIMEOUT, cwd=None, env=None):
+    c = AsyncCommand(command, timeout=timeout)
+    await c.run(binary=binary, cwd=cwd, env=env)
+    return c
@@ -0,0 +1,145 @@
+import os
+import time
+import traceback
+from collections import defaultdict
+from threading import Event, Lock, Thread
+from typing import Callable, Dict, List, NamedTuple, Tuple, Union
+
+from conger.task_dispatcher import Process, Job
+
+CLK_TCK = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+
+class Sample(NamedTuple):
+    cpu: float  # percent of one core, summed over the process tree
+    rss: int  # bytes
+    read_bytes: int
+    write_bytes: int
+    processes: int
+
+
+def _read(path: str) -> Union[bytes, None]:
+    try:
+        with open(path, 'rb') as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+def _scan() -> Tuple[Dict[int, Tuple[int, int]], Dict[int, List[int]]]:
+    """One pass over /proc: {pid: (cpu ticks, rss pages)} and {ppid: [pid, ...]}."""
+    stats = {}
+    children = defaultdict(list)
+    for name in os.listdir('/proc'):
+        if not name.isdigit():
+            continue
+        data = _read(f'/proc/{name}/stat')
+        if data is None:
+            continue
+        # comm (field 2) may contain spaces and parentheses; everything after the last ')' is numeric.
+        fields = data[data.rindex(b')') + 2:].split()
+        pid = int(name)
+        ticks = int(fields[11]) + int(fields[12]) + int(fields[13]) + int(fields[14])
+        stats[pid] = (ticks, int(fields[21]))
+        children[int(fields[1])].append(pid)
+    return stats, children
+
+
+def _io(pid: int) -> Tuple[int, int]:
+    data = _read(f'/proc/{pid}/io')
+    if data is None:
+        return 0, 0
+    values = dict(line.split(b': ') for line in data.splitlines() if b': ' in line)
+    return int(values.get(b'read_bytes', 0)), int(values.get(b'write_bytes', 0))
+
+
+class Sampler:
+    """Samples CPU, memory and I/O of watched tasks and their descendants.
+
+    All watched tasks share one thread and one /proc scan per tick, so the cost
+    is a single directory walk plus a few small reads per task process. Samples
+    are only available where /proc exists (Linux).
+    """
+
+    def __init__(self, interval: float = 1.0):
+        self.interval = interval
+        self._watched: Dict[Union[Process, Job], Callable[[Sample], None]] = {}
+        self._previous: Dict[Union[Process, Job], Tuple[int, float]] = {}
+        self._lock = Lock()
+        self._wakeup = Event()
+        self._thread = None
+
+    def watch(self, target: Union[Process, Job], callback: Callable[[Sample], None]):
+        """Calls callback(sample) every interval until target exits. A pending
+        Job is picked up once its process starts."""
+        with self._lock:
+            self._watched[target] = callback
+            if self._thread is None:
+                self._thread = Thread(target=self._run, name='conger-metrics', daemon=True)
+                self._thread.start()
+
+    def unwatch(self, target: Union[Process, Job]):
+        with self._lock:
+            self._watched.pop(target, None)
+            self._previous.pop(target, None)
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.interval)
+            with self._lock:
+                watched = list(self._watched.items())
+                if not watched:
+                    self._thread = None
+                    return
+            try:
+                self.sample(watched)
+            except Exception:
+                traceback.print_exc()
+
+    @staticmethod
+    def _process(target: Union[Process, Job]) -> Union[Process, None]:
+        if isinstance(target, Job):
+            if target.state in (Job.DONE, Job.CANCELLED):
+                return None
+            return target.process
+        return None if target.exited else target
+
+    def sample(self, watched: List[Tuple[Union[Process, Job], Callable[[Sample], None]]]):
+        if not os.path.isdir('/proc'):
+            return
+        stats, children = _scan()
+        now = time.monotonic()
+        for target, callback in watched:
+            process = self._process(target)
+            if process is None:
+                if not isinstance(target, Job) or target.state != Job.PENDING:
+                    self.unwatch(target)
+                continue
+            ticks = rss = read_bytes = write_bytes = count = 0
+            stack = [process.cmd.pid]
+            while stack:
+                pid = stack.pop()
+                if pid not in stats:
+                    continue
+                pid_ticks, pid_rss = stats[pid]
+                pid_read, pid_write = _io(pid)
+                ticks += pid_ticks
+                rss += pid_rss
+                read_bytes += pid_read
+                write_bytes += pid_write
+                count += 1
+                stack.extend(children.get(pid, ()))
+            if not count:
+                continue
+            last_ticks, last_time = self._previous.get(target, (ticks, now))
+            self._previous[target] = (ticks, now)
+            elapsed = now - last_time
+            cpu = max(ticks - last_ticks, 0) / CLK_TCK / elapsed * 100 if elapsed > 0 else 0.0
+            try:
+                callback(Sample(cpu, rss * PAGE_SIZE, read_bytes, write_bytes, count))
+            except Exception:
+                traceback.print_exc()
+
+
+sampler = Sampler()
@@ -0,0 +1,72 @@
+import hashlib
+import os
+import tempfile
+from typing import Union
+
+from conger.base import BaseComponent
+
+_SOURCES = ('base.py', 'components.py', 'style.py')
+_source_digest = None
+
+
+def _sources() -> bytes:
+    """Digest of the modules that produce the page, so upgrading conger invalidates old pages."""
+    global _source_digest
+    if _source_digest is None:
+        h = hashlib.blake2b(digest_size=16)
+        for name in _SOURCES:
+            with open(os.path.join(os.path.dirname(__file__), name), 'rb') as f:
+                h.update(f.read())
+        _source_digest = h.digest()
+    return _source_digest
+
+
+def page_key(component: BaseComponent) -> str:
+    """Hash of a component tree and its styles, computed without rendering it."""
+    parts = []
+    component._digest(parts.append)
+    return hashlib.blake2b(_sources() + ''.join(parts).encode(), digest_size=16).hexdigest()
+
+
+class PageCache:
+    """Rendered pages on disk, one file per page_key. Only the `keep` most
+    recently written pages are kept."""
+
+    def __init__(self, directory: Union[str, None] = None, keep: int = 8):
+        if directory is None:
+            base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+            directory = os.path.join(base, 'conger')
+        self.directory = directory
+        self.keep = keep
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f'{key}.html')
+
+    def load(self, key: str) -> Union[str, None]:
+        try:
+            with open(self._path(key), 'r', encoding='utf-8') as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def store(self, key: str, page: str):
+        """Writes the page atomically. A read-only or missing cache directory only
+        means the next launch renders again."""
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                f.write(page)
+            os.replace(tmp, self._path(key))
+            self._prune()
+        except OSError:
+            pass
+
+    def _prune(self):
+        pages = [entry for entry in os.scandir(self.directory) if entry.name.endswith('.html')]
+        pages.sort(key=lambda entry: entry.stat().st_mtime, reverse=True)
+        for entry in pages[self.keep:]:
+            os.unlink(entry.path)
+
+
+page_cache = PageCache()
@@ -0,0 +1,171 @@
+from threading import Lock
+from typing import Callable, Dict, Iterable, List, Union
+
+from conger.task_dispatcher import Scheduler, Job, default_scheduler
+
+
+class Step:
+    WAITING = 'waiting'
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    CANCELLED = 'cancelled'
+
+    def __init__(self, name: str, cmd: str, after: Iterable[str], priority: int):
+        self.name = name
+        self.cmd = cmd
+        self.after = tuple(after)
+        self.priority = priority
+        self.dependents: List['Step'] = []
+        self.state = Step.WAITING
+        self.job: Union[Job, None] = None
+        self._remaining = 0
+
+    def __repr__(self):
+        return f'<Step {self.name!r} {self.state}>'
+
+    @property
+    def return_code(self):
+        if self.job is None or self.job.process is None:
+            return None
+        return self.job.process.return_code
+
+
+class Pipeline:
+    """A DAG of shell commands.
+
+    Each step starts as soon as every step it comes after has succeeded, so
+    independent branches run in parallel (within the scheduler's limit). When a
+    step fails, everything downstream of it is cancelled; unrelated branches
+    keep running.
+    """
+
+    def __init__(self, scheduler: Union[Scheduler, None] = None):
+        self.scheduler = scheduler if scheduler is not None else default_scheduler
+        self.steps: Dict[str, Step] = {}
+        self.on_change: Union[Callable[[Step], None], None] = None
+        self.on_finish: Union[Callable[['Pipeline'], None], None] = None
+        self._lock = Lock()
+        self._active = 0
+
+    def step(self, name: str, cmd: str, after: Iterable[str] = (), priority: int = 0) -> 'Pipeline':
+        if name in self.steps:
+            raise ValueError(f'duplicate step {name!r}')
+        self.steps[name] = Step(name, cmd, after, priority)
+        return self
+
+    @property
+    def running(self) -> bool:
+        return self._active > 0
+
+    @property
+    def ok(self) -> bool:
+        return all(step.state == Step.DONE for step in self.steps.values())
+
+    def _link(self):
+        for step in self.steps.values():
+            step.dependents = []
+        for step in self.steps.values():
+            for name in step.after:
+                if name not in self.steps:
+                    raise ValueError(f'step {step.name!r} comes after unknown step {name!r}')
+                self.steps[name].dependents.append(step)
+            step._remaining = len(step.after)
+
+        # Kahn's algorithm; anything left unvisited sits on a cycle.
+        remaining = {step.name: step._remaining for step in self.steps.values()}
+        ready = [name for name, count in remaining.items() if count == 0]
+        visited = 0
+        while ready:
+            visited += 1
+            for dependent in self.steps[ready.pop()].dependents:
+                remaining[dependent.name] -= 1
+                if remaining[dependent.name] == 0:
+                    ready.append(dependent.name)
+        if visited != len(self.steps):
+            raise ValueError('pipeline steps form a cycle')
+
+    def run(self, on_change: Callable[[Step], None] = None,
+            on_finish: Callable[['Pipeline'], None] = None) -> 'Pipeline':
+        """Starts every step whose dependencies are met. on_change(step) is called
+        on each state change and on_finish(pipeline) once nothing is left to run."""
+        if self.running:
+            raise RuntimeError('pipeline is already running')
+        if on_change is not None:
+            self.on_change = on_change
+        if on_finish is not None:
+            self.on_finish = on_finish
+        self._link()
+        for step in self.steps.values():
+            self._set_state(step, Step.WAITING)
+            step.job = None
+        self._active = len(self.steps)
+        if not self.steps:
+            if self.on_finish is not None:
+                self.on_finish(self)
+            return self
+        for step in list(self.steps.values()):
+            if step._remaining == 0:
+                self._submit(step)
+        return self
+
+    def cancel(self):
+        """Cancels every step that has not finished yet."""
+        with self._lock:
+            steps = [step for step in self.steps.values() if step.state in (Step.WAITING, Step.PENDING, Step.RUNNING)]
+        for step in steps:
+            if step.job is not None:
+                step.job.cancel()
+            else:
+                self._finish(step, Step.CANCELLED)
+
+    def _set_state(self, step: Step, state: str):
+        step.state = state
+        if self.on_change is not None:
+            self.on_change(step)
+
+    def _submit(self, step: Step):
+        self._set_state(step, Step.PENDING)
+        step.job = Job(self.scheduler, step.cmd, lambda: self._on_exit(step),
+                       lambda: self._set_state(step, Step.RUNNING), step.priority, {})
+        self.scheduler.enqueue(step.job)
+
+    def _on_exit(self, step: Step):
+        if step.job.state == Job.CANCELLED:
+            self._finish(step, Step.CANCELLED)
+        elif step.return_code == 0:
+            self._finish(step, Step.DONE)
+        else:
+            self._finish(step, Step.FAILED)
+
+    def _finish(self, step: Step, state: str):
+        ready = []
+        cancelled = []
+        with self._lock:
+            if step.state in (Step.DONE, Step.FAILED, Step.CANCELLED):
+                return
+            step.state = state
+            self._active -= 1
+            if state == Step.DONE:
+                for dependent in step.dependents:
+                    dependent._remaining -= 1
+                    if dependent._remaining == 0 and dependent.state == Step.WAITING:
+                        ready.append(dependent)
+            else:
+                stack = list(step.dependents)
+                while stack:
+                    dependent = stack.pop()
+                    if dependent.state == Step.WAITING:
+                        dependent.state = Step.CANCELLED
+                        self._active -= 1
+                        cancelled.append(dependent)
+                        stack.extend(dependent.dependents)
+            finished = self._active == 0
+        self._set_state(step, state)
+        for dependent in cancelled:
+            self._set_state(dependent, Step.CANCELLED)
+        for dependent in ready:
+            self._submit(dependent)
+        if finished and self.on_finish is not None:
+            self.on_finish(self)
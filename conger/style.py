@@ -0,0 +1,151 @@
+import hashlib
+import sys
+from typing import Dict, Iterable, List, Set, Tuple, Union
+
+
+class Style:
+    """Immutable, interned map of CSS properties.
+
+    Equal styles are a single shared instance, so thousands of identically styled
+    components cost one object. Writing a property returns the style with that
+    property replaced and moved to the end, matching the cascade of a re-declaration.
+    """
+    __slots__ = ('_properties', '_css', '_derived')
+    _interned: Dict[str, 'Style'] = {}
+
+    def __new__(cls, properties: Union[Dict[str, str], None] = None):
+        properties = dict(properties) if properties is not None else {}
+        css = ''.join(f'{prop}: {value}; ' for prop, value in properties.items())
+        style = cls._interned.get(css)
+        if style is None:
+            style = super().__new__(cls)
+            style._properties = properties
+            style._css = sys.intern(css)
+            style._derived = {}
+            cls._interned[css] = style
+        return style
+
+    @classmethod
+    def parse(cls, declarations: str) -> 'Style':
+        properties = {}
+        for declaration in declarations.split(';'):
+            prop, _, value = declaration.partition(':')
+            if prop.strip() and value.strip():
+                properties.pop(prop.strip(), None)
+                properties[prop.strip()] = value.strip()
+        return cls(properties)
+
+    def with_property(self, prop: str, value: str) -> 'Style':
+        style = self._derived.get((prop, value))
+        if style is None:
+            properties = dict(self._properties)
+            properties.pop(prop, None)
+            properties[prop] = value
+            style = self._derived[(prop, value)] = Style(properties)
+        return style
+
+    def merged(self, other: 'Style') -> 'Style':
+        properties = dict(self._properties)
+        for prop, value in other._properties.items():
+            properties.pop(prop, None)
+            properties[prop] = value
+        return Style(properties)
+
+    def css(self) -> str:
+        return self._css
+
+    def __getitem__(self, prop: str) -> str:
+        return self._properties[prop]
+
+    def __contains__(self, prop: str) -> bool:
+        return prop in self._properties
+
+    def __eq__(self, other):
+        return isinstance(other, Style) and self._css == other._css
+
+    def __hash__(self):
+        return hash(self._css)
+
+    def __repr__(self):
+        return f'<Style {self._css!r}>'
+
+
+class StyleSheet:
+    """Assigns one shared CSS class to each distinct inline style.
+
+    A page lists only the classes its render pass used. Between begin_pass()
+    and end_pass() every class requested is collected; a component served from
+    its render cache reports the classes it recorded with use(). Classes
+    requested outside a pass and not yet on the page wait for take_new().
+    """
+
+    def __init__(self):
+        self._classes: Dict[str, str] = {}
+        self._used: Union[Dict[str, str], None] = None
+        self._frame: Union[List[Tuple[str, str]], None] = None
+        self._on_page: Set[str] = set()
+        self._new: Dict[str, str] = {}
+
+    def class_for(self, style: str) -> str:
+        name = self._classes.get(style)
+        if name is None:
+            name = 'c' + hashlib.blake2s(style.encode(), digest_size=6).hexdigest()
+            self._classes[style] = name
+        if self._frame is not None:
+            self._frame.append((style, name))
+        self._request(style, name)
+        return name
+
+    def _request(self, style: str, name: str):
+        if self._used is not None:
+            self._used[style] = name
+        elif name not in self._on_page:
+            self._new[style] = name
+
+    def open_frame(self) -> Union[List[Tuple[str, str]], None]:
+        """Starts recording the classes one component requests while rendering its
+        own markup. Returns the enclosing frame for close_frame."""
+        outer, self._frame = self._frame, []
+        return outer
+
+    def close_frame(self, outer: Union[List[Tuple[str, str]], None]) -> Tuple[Tuple[str, str], ...]:
+        frame, self._frame = self._frame, outer
+        return tuple(frame)
+
+    def use(self, classes: Iterable[Tuple[str, str]]):
+        """Requests classes recorded by close_frame again, for a cache hit."""
+        for style, name in classes:
+            self._request(style, name)
+
+    def begin_pass(self):
+        self._used = {}
+
+    def end_pass(self) -> str:
+        """Rules for the classes used since begin_pass(), which are now the ones on the page."""
+        used, self._used = self._used or {}, None
+        self._on_page = set(used.values())
+        return self._rules(used.items())
+
+    def mark_emitted(self):
+        """Records every class requested outside a pass as already on the page."""
+        self._on_page.update(self._new.values())
+        self._new.clear()
+
+    def take_new(self) -> str:
+        """Rules for the classes requested since the page was written that it does
+        not have yet, for components rendered afterwards."""
+        if not self._new:
+            return ''
+        new, self._new = self._new, {}
+        self._on_page.update(new.values())
+        return self._rules(new.items())
+
+    @staticmethod
+    def _rules(classes: Iterable[Tuple[str, str]]) -> str:
+        return '\n'.join(f'.{name} {{ {style}}}' for style, name in classes)
+
+    def __len__(self):
+        return len(self._classes)
+
+
+stylesheet = StyleSheet()
@@ -1,19 +1,457 @@
-from typing import Callable
-from threading import Thread
+import codecs
+import heapq
+import itertools
+import os
+import selectors
+import traceback
+from collections import deque
+from itertools import islice
+from typing import Callable, Dict, Iterator, List, Tuple, Union
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread, Condition, Event, Lock
 from conger import delegator
 
+MAX_LINE = 64 * 1024
+
+
+class OutputBuffer:
+    """Fixed-size ring buffer of (stream, line) pairs that can be followed while a process runs."""
+
+    def __init__(self, max_lines: int = 1000):
+        self._lines = deque(maxlen=max_lines)
+        self._seq = 0
+        self._closed = False
+        self._cond = Condition()
+
+    def append(self, stream: str, line: str):
+        with self._cond:
+            self._seq += 1
+            self._lines.append((self._seq, stream, line))
+            self._cond.notify_all()
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def tail(self, n: int = None) -> List[Tuple[str, str]]:
+        with self._cond:
+            lines = list(self._lines)
+        if n is not None:
+            lines = lines[-n:] if n else []
+        return [(stream, line) for _, stream, line in lines]
+
+    def follow(self) -> Iterator[Tuple[str, str]]:
+        """Yields retained and new lines until the process' output closes. Lines
+        overwritten before a slow consumer reaches them are skipped."""
+        seq = 0
+        while True:
+            with self._cond:
+                while self._seq <= seq and not self._closed:
+                    self._cond.wait()
+                first = self._lines[0][0] if self._lines else self._seq + 1
+                pending = list(islice(self._lines, max(0, seq + 1 - first), None))
+                closed = self._closed
+            for seq, stream, line in pending:
+                yield stream, line
+            if closed and not pending:
+                return
+
+
+class _LineSplitter:
+    def __init__(self, stream: str, emit: Callable[[str, str], None]):
+        self.stream = stream
+        self.emit = emit
+        self.decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        self.partial = ''
+
+    def feed(self, data: bytes, final: bool = False):
+        text = self.partial + self.decoder.decode(data, final)
+        lines = text.split('\n')
+        self.partial = lines.pop()
+        if len(self.partial) > MAX_LINE:
+            lines.append(self.partial)
+            self.partial = ''
+        if final and self.partial:
+            lines.append(self.partial)
+            self.partial = ''
+        for line in lines:
+            self.emit(self.stream, line.rstrip('\r'))
+
+
+def _run_callback(callback: Callable):
+    try:
+        callback()
+    except Exception:
+        traceback.print_exc()
+
+
+class Supervisor:
+    """Waits on every running Process from a single thread.
+
+    Output pipes and pidfds of all children share one selector; exit callbacks
+    run on a small worker pool, so the thread count does not grow with the
+    number of processes. Where pidfds are unavailable, exited children are
+    found by polling.
+    """
+
+    def __init__(self, workers: int = 4):
+        self._selector = selectors.DefaultSelector()
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        self._selector.register(self._wakeup_r, selectors.EVENT_READ)
+        self._lock = Lock()
+        self._incoming: List['Process'] = []
+        self._polled: List['Process'] = []
+        self._pool = ThreadPoolExecutor(workers, thread_name_prefix='conger-exit')
+        self._thread = None
+
+    def watch(self, process: 'Process'):
+        with self._lock:
+            self._incoming.append(process)
+            if self._thread is None:
+                self._thread = Thread(target=self._run, name='conger-supervisor', daemon=True)
+                self._thread.start()
+        os.write(self._wakeup_w, b'\0')
+
+    def _register(self, process: 'Process'):
+        for fd in process._splitters:
+            # Non-blocking, so the pipes can be drained at exit without waiting for EOF.
+            os.set_blocking(fd, False)
+            self._selector.register(fd, selectors.EVENT_READ, (process, fd))
+        try:
+            pidfd = os.pidfd_open(process.cmd.pid)
+        except (AttributeError, OSError):
+            self._polled.append(process)
+        else:
+            self._selector.register(pidfd, selectors.EVENT_READ, (process, None))
+
+    def _run(self):
+        while True:
+            for key, _ in self._selector.select(0.1 if self._polled else None):
+                if key.data is None:
+                    os.read(self._wakeup_r, 4096)
+                    with self._lock:
+                        incoming, self._incoming = self._incoming, []
+                    for process in incoming:
+                        self._register(process)
+                    continue
+                process, fd = key.data
+                if fd is None:
+                    self._selector.unregister(key.fd)
+                    os.close(key.fd)
+                    process.cmd.subprocess.poll()
+                else:
+                    self._read(process, fd)
+                self._check(process)
+            for process in list(self._polled):
+                if process.cmd.subprocess.poll() is not None:
+                    self._check(process)
+
+    def _read(self, process: 'Process', fd: int) -> bool:
+        """Feeds what one output pipe has available. Returns False once it has nothing more for now."""
+        try:
+            data = os.read(fd, 65536)
+        except BlockingIOError:
+            return False
+        if data:
+            process._splitters[fd].feed(data)
+            return True
+        self._selector.unregister(fd)
+        process._splitters.pop(fd).feed(b'', final=True)
+        return False
+
+    def _check(self, process: 'Process'):
+        # Exit is reported as soon as the process is gone. A background child may
+        # keep the pipes open much longer; they are read until EOF regardless.
+        if not process.exited and process.cmd.subprocess.returncode is not None:
+            if process in self._polled:
+                self._polled.remove(process)
+            # Everything the process itself printed is in the pipes by now.
+            for fd in list(process._splitters):
+                while fd in process._splitters and self._read(process, fd):
+                    pass
+            process.exited = True
+            process._done.set()
+            if process.exit_callback is not None:
+                self._pool.submit(_run_callback, process.exit_callback)
+        if process.exited and not process._splitters:
+            process.cmd.block()
+            process.output.close()
+
+
+supervisor = Supervisor()
+
 
 class Process:
-    def __init__(self, command: str, exit_callback: Callable = None):
-        self.cmd = delegator.run(command, False)
+    def __init__(self, command: str, exit_callback: Callable = None,
+                 output_callback: Callable[[str, str], None] = None, buffer_lines: int = 1000,
+                 keep_stdin: bool = False):
+        self.cmd = delegator.run(command, False, fast=True)
+        if not keep_stdin:
+            self.cmd.std_in.close()
         self.exited = False
-        self.th = Thread(target=self._block_thread, args=(exit_callback, ), name='block')
-        self.th.start()
+        self.exit_callback = exit_callback
+        self.output = OutputBuffer(buffer_lines)
+        self.output_callbacks: List[Callable[[str, str], None]] = []
+        if output_callback is not None:
+            self.output_callbacks.append(output_callback)
+        self._splitters: Dict[int, _LineSplitter] = {
+            self.cmd.std_out.fileno(): _LineSplitter('stdout', self._emit),
+            self.cmd.std_err.fileno(): _LineSplitter('stderr', self._emit),
+        }
+        self._done = Event()
+        supervisor.watch(self)
 
-    def _block_thread(self, callback: Callable):
-        self.cmd.block()
-        if callback is not None:
-            callback()
+    def _emit(self, stream: str, line: str):
+        self.output.append(stream, line)
+        for callback in self.output_callbacks:
+            # Runs on the supervisor thread; a failing callback must not stop it.
+            try:
+                callback(stream, line)
+            except Exception:
+                traceback.print_exc()
+
+    def on_output(self, callback: Callable[[str, str], None]) -> 'Process':
+        """Calls callback(stream, line) for every line the process prints from now on.
+        Callbacks run on the supervisor thread and should return quickly."""
+        self.output_callbacks.append(callback)
+        return self
+
+    def lines(self) -> Iterator[Tuple[str, str]]:
+        """Yields (stream, line) pairs, starting with the buffered tail, until the process'
+        output closes. That can be after it exits when a background child keeps the pipes open."""
+        return self.output.follow()
+
+    def wait(self, timeout: float = None) -> bool:
+        return self._done.wait(timeout)
+
+    def send(self, text: str):
+        """Writes text to the process' stdin (only open when started with keep_stdin)."""
+        self.cmd.std_in.write(text.encode('utf-8'))
+        self.cmd.std_in.flush()
+
+    def close_stdin(self):
+        self.cmd.std_in.close()
+
+    @property
+    def return_code(self):
+        return self.cmd.return_code
 
     def kill(self):
         self.cmd.kill()
+
+
+class WarmPool:
+    """Keeps `size` pre-spawned instances of a command parked so that starting one
+    is only a handover.
+
+    Parked instances run with stdin open, so a command can finish its slow
+    initialization and then block reading stdin. On acquire() the instance gets
+    `start_input` (if any), its stdin is closed like any other Process, and a
+    replacement is spawned in the background. Output printed while parked stays
+    in the instance's ring buffer.
+    """
+
+    def __init__(self, command: str, size: int = 1, start_input: Union[str, None] = None,
+                 buffer_lines: int = 1000):
+        self.command = command
+        self.size = size
+        self.start_input = start_input
+        self.buffer_lines = buffer_lines
+        self._idle: deque = deque()
+        self._lock = Lock()
+        self._closed = False
+        self._fill()
+
+    @property
+    def idle(self) -> int:
+        return len(self._idle)
+
+    def _spawn(self) -> Process:
+        process = Process(self.command, buffer_lines=self.buffer_lines, keep_stdin=True)
+
+        def parked_exit():
+            self._on_exit(process, parked_exit)
+
+        process.exit_callback = parked_exit
+        return process
+
+    def _fill(self):
+        while True:
+            with self._lock:
+                if self._closed or len(self._idle) >= self.size:
+                    return
+            process = self._spawn()
+            with self._lock:
+                if self._closed:
+                    process.kill()
+                    return
+                self._idle.append(process)
+
+    def _on_exit(self, process: Process, parked_exit: Callable):
+        with self._lock:
+            if process in self._idle:
+                # Died while parked; a replacement is spawned on the next acquire.
+                self._idle.remove(process)
+                return
+            callback = process.exit_callback
+        # Handed over between exiting and this callback running.
+        if callback is not None and callback is not parked_exit:
+            callback()
+
+    def acquire(self, exit_callback: Callable = None,
+                output_callback: Callable[[str, str], None] = None) -> Process:
+        """Hands over a parked instance (or spawns one if none is ready)."""
+        with self._lock:
+            process = None
+            while self._idle and process is None:
+                process = self._idle.popleft()
+                if process.exited:
+                    process = None
+            if process is not None:
+                process.exit_callback = exit_callback
+        if process is None:
+            process = Process(self.command, exit_callback, buffer_lines=self.buffer_lines, keep_stdin=True)
+        if output_callback is not None:
+            process.on_output(output_callback)
+        try:
+            if self.start_input is not None:
+                process.send(self.start_input)
+            process.close_stdin()
+        except (BrokenPipeError, ValueError):
+            pass  # The instance exited already; its exit callback reports that.
+        supervisor._pool.submit(self._fill)
+        return process
+
+    def close(self):
+        """Kills every parked instance."""
+        with self._lock:
+            self._closed = True
+            idle, self._idle = list(self._idle), deque()
+        for process in idle:
+            process.kill()
+
+
+class Job:
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    CANCELLED = 'cancelled'
+
+    def __init__(self, scheduler: 'Scheduler', command: str, exit_callback: Union[Callable, None],
+                 start_callback: Union[Callable, None], priority: int, process_kwargs: dict,
+                 pool: Union[WarmPool, None] = None):
+        self.scheduler = scheduler
+        self.command = command
+        self.exit_callback = exit_callback
+        self.start_callback = start_callback
+        self.priority = priority
+        self.process_kwargs = process_kwargs
+        self.pool = pool
+        self.state = Job.PENDING
+        self.process: Union[Process, None] = None
+        self.cancelled = False
+        self._spawned = Event()
+
+    def __repr__(self):
+        return f'<Job {self.command!r} {self.state}>'
+
+    def cancel(self):
+        """Removes a pending job from the queue, or kills it if it is already running."""
+        self.scheduler.cancel(self)
+
+
+class Scheduler:
+    """Runs Processes with at most max_running alive at once (no limit when None).
+
+    Jobs wait in a queue ordered by priority (higher first), then by submission
+    order, and start as soon as a running job exits. exit_callback runs when a
+    job ends, including when it is cancelled before starting.
+    """
+
+    def __init__(self, max_running: Union[int, None] = None):
+        self.max_running = max_running
+        self._queue: List[Tuple[int, int, Job]] = []
+        self._seq = itertools.count()
+        self._running = 0
+        self._lock = Lock()
+
+    @property
+    def running(self) -> int:
+        return self._running
+
+    @property
+    def pending(self) -> int:
+        return len(self._queue)
+
+    def submit(self, command: str, exit_callback: Callable = None, start_callback: Callable = None,
+               priority: int = 0, pool: Union[WarmPool, None] = None, **process_kwargs) -> Job:
+        """Queues a command. With a pool the job takes a parked instance from it
+        instead of spawning the command when it starts."""
+        job = Job(self, command, exit_callback, start_callback, priority, process_kwargs, pool)
+        self.enqueue(job)
+        return job
+
+    def enqueue(self, job: Job):
+        with self._lock:
+            heapq.heappush(self._queue, (-job.priority, next(self._seq), job))
+        self._start_ready()
+
+    def set_limit(self, max_running: Union[int, None]):
+        self.max_running = max_running
+        self._start_ready()
+
+    def cancel(self, job: Job):
+        with self._lock:
+            if job.state == Job.PENDING:
+                job.state = Job.CANCELLED
+                job.cancelled = True
+                self._queue = [entry for entry in self._queue if entry[2] is not job]
+                heapq.heapify(self._queue)
+                cancelled = True
+            else:
+                cancelled = False
+        if cancelled:
+            if job.exit_callback is not None:
+                job.exit_callback()
+        elif job.state == Job.RUNNING and job.process is not None:
+            job.cancelled = True
+            job.process.kill()
+
+    def _start_ready(self):
+        started = []
+        with self._lock:
+            while self._queue and (self.max_running is None or self._running < self.max_running):
+                job = heapq.heappop(self._queue)[2]
+                job.state = Job.RUNNING
+                self._running += 1
+                started.append(job)
+        for job in started:
+            # Announced before spawning so that a job exiting immediately can
+            # never report its exit ahead of its start.
+            if job.start_callback is not None:
+                job.start_callback()
+            try:
+                if job.pool is not None:
+                    job.process = job.pool.acquire(lambda job=job: self._on_exit(job), **job.process_kwargs)
+                else:
+                    job.process = Process(job.command, lambda job=job: self._on_exit(job), **job.process_kwargs)
+            except Exception:
+                traceback.print_exc()
+                job._spawned.set()
+                self._on_exit(job)
+            else:
+                job._spawned.set()
+
+    def _on_exit(self, job: Job):
+        # A very short-lived process can exit before Process() has returned.
+        job._spawned.wait()
+        with self._lock:
+            job.state = Job.CANCELLED if job.cancelled else Job.DONE
+            self._running -= 1
+        self._start_ready()
+        if job.exit_callback is not None:
+            job.exit_callback()
+
+
+default_scheduler = Scheduler()
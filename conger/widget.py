@@ -1,17 +1,28 @@
-from typing import Tuple
+from typing import Tuple, Dict
 
 from conger.components import *
 from conger import *
-from conger.task_dispatcher import Process
+from conger.task_dispatcher import Process, Scheduler, Job, WarmPool, default_scheduler
+from conger.pipeline import Pipeline, Step
+from conger.metrics import Sample, sampler
 
 
 class TaskWidget():
 
-    def __init__(self, name: str, cmd: str, icon_path: str, color: str):
+    def __init__(self, name: str, cmd: str, icon_path: str, color: str,
+                 scheduler: Union[Scheduler, None] = None, priority: int = 0,
+                 warm: int = 0, start_input: Union[str, None] = None, metrics: bool = False,
+                 log: Union[LogView, None] = None):
         self.cmd = cmd
-        self.process: Union[None, Process] = None
+        self.scheduler = scheduler if scheduler is not None else default_scheduler
+        self.priority = priority
+        self.pool = WarmPool(cmd, warm, start_input) if warm else None
+        self.metrics = metrics
+        self.log = log
+        self.job: Union[None, Job] = None
         self.name = name
         self.txt_component: Text
+        self.metrics_component: Union[None, Text] = None
         self.control_text_component: Text
         self.control_button_component: Button
         self.icon = icon_path
@@ -29,6 +40,8 @@ class TaskWidget():
                     .align_items_center()
                     .rounded_corner(9999),
                     txt := Text(self.name).font_color('#FFFFFF').font_size(20).margin(0, 0, 0, 10),
+                    *((metrics := Text('').font_color('#FFFFFFA0').font_size(12).margin(0, 0, 0, 10),)
+                      if self.metrics else ()),
                 )).align_items_center(),
                 control_button := Button((control_text := Text('启动')
                                           .margin(0, 0, 0, 0)
@@ -52,6 +65,7 @@ class TaskWidget():
             .margin(0, 0, 10, 0)
 
         self.txt_component = txt
+        self.metrics_component = metrics if self.metrics else None
         self.control_text_component = control_text
         self.control_button_component = control_button
         return component
@@ -59,26 +73,136 @@ class TaskWidget():
     def create_component(self):
         return self._component()
 
+    @property
+    def process(self) -> Union[None, Process]:
+        return self.job.process if self.job is not None else None
+
+    def start_callback(self):
+        self.isRunning = True
+        if self.log is not None:
+            self.log.clear()
+        set_background(self.control_button_component.serial, self.color)
+        set_font_color(self.control_text_component.serial, "#FFFFFF")
+        set_text(self.control_text_component.serial, '停止')
+
     def exit_callback(self):
         set_background(self.control_button_component.serial, '#FFFFFF')
         set_font_color(self.control_text_component.serial, self.color)
         set_text(self.control_text_component.serial, '启动')
+        if self.metrics_component is not None:
+            sampler.unwatch(self.job)
+            set_text(self.metrics_component.serial, '')
 
         self.isRunning = False
+        self.job = None
+
+    def on_sample(self, sample: Sample):
+        set_text(self.metrics_component.serial, f'CPU {sample.cpu:.0f}% · 内存 {sample.rss / 1048576:.0f} MB')
 
     def __call__(self, *args, **kwargs):
         return self._component()
 
     def on_start_click(self):
-        if not self.isRunning:
-            self.isRunning = True
+        if self.job is None:
+            output_callback = self.log.write if self.log is not None else None
+            # Assigned before enqueueing: a job that fails to spawn, or exits at
+            # once, runs exit_callback (which clears self.job) inside enqueue.
+            job = self.job = Job(self.scheduler, self.cmd, self.exit_callback, self.start_callback, self.priority,
+                                 {'output_callback': output_callback}, self.pool)
+            if self.metrics_component is not None:
+                sampler.watch(job, self.on_sample)
+            self.scheduler.enqueue(job)
+            if job.state == Job.PENDING:
+                set_text(self.control_text_component.serial, '排队')
+
+        else:
+            self.job.cancel()
+
+
+class PipelineWidget():
+    STATUS = {
+        Step.WAITING: ('等待', '#FFFFFFA0'),
+        Step.PENDING: ('排队', '#FFFFFFA0'),
+        Step.RUNNING: ('运行中', '#FFFFFF'),
+        Step.DONE: ('完成', '#B9F6CA'),
+        Step.FAILED: ('失败', '#FF8A80'),
+        Step.CANCELLED: ('已取消', '#FFFFFF70'),
+    }
+
+    def __init__(self, name: str, pipeline: Pipeline, color: str):
+        self.name = name
+        self.pipeline = pipeline
+        self.color = color
+        self.status_components: Dict[str, Text] = {}
+        self.control_text_component: Text
+        self.control_button_component: Button
+
+    def _step_row(self, step: Step):
+        text, color = self.STATUS[step.state]
+        status = Text(text).font_color(color).font_size(13).margin(0, 0, 0, 0)
+        self.status_components[step.name] = status
+        return HorizontalStack((
+                Text(step.name).font_color('#FFFFFF').font_size(15).margin(0, 0, 0, 0),
+                status,
+        ))  .align_items_center() \
+            .justify_between() \
+            .padding(4, 0, 4, 45)
+
+    def _component(self):
+        component = VerticalStack((
+                HorizontalStack((
+                    Text(self.name).font_color('#FFFFFF').font_size(20).margin(0, 0, 0, 0),
+                    control_button := Button((control_text := Text('启动')
+                                              .margin(0, 0, 0, 0)
+                                              .font_color(self.color),))
+                        .center_text()
+                        .height(25)
+                        .font_size(13)
+                        .background("#FFFFFF")
+                        .border(2, '#FFFFFF')
+                        .rounded_corner(9999)
+                        .on_click(self.on_start_click)
+                        .width(50),
+                )).align_items_center().justify_between().margin(0, 0, 6, 0),
+                *(self._step_row(step) for step in self.pipeline.steps.values()),
+        ))  .padding(10, 10, 10, 10) \
+            .background(self.color) \
+            .rounded_corner(10)\
+            .shadow(self.color)\
+            .margin(0, 0, 10, 0)
+
+        self.control_text_component = control_text
+        self.control_button_component = control_button
+        return component
+
+    def __call__(self, *args, **kwargs):
+        return self._component()
+
+    def on_step_change(self, step: Step):
+        status = self.status_components.get(step.name)
+        if status is not None:
+            text, color = self.STATUS[step.state]
+            set_text(status.serial, text)
+            set_font_color(status.serial, color)
+
+    def on_finish(self, pipeline: Pipeline):
+        set_background(self.control_button_component.serial, '#FFFFFF')
+        set_font_color(self.control_text_component.serial, self.color)
+        set_text(self.control_text_component.serial, '启动')
+
+    def on_start_click(self):
+        if not self.pipeline.running:
             set_background(self.control_button_component.serial, self.color)
             set_font_color(self.control_text_component.serial, "#FFFFFF")
-            self.process = Process(self.cmd, self.exit_callback)
             set_text(self.control_text_component.serial, '停止')
+            try:
+                self.pipeline.run(self.on_step_change, self.on_finish)
+            except (ValueError, RuntimeError):
+                self.on_finish(self.pipeline)
+                raise
 
         else:
-            self.process.kill()
+            self.pipeline.cancel()
 
 
 class CustomTaskComponent:
@@ -87,35 +211,51 @@ class CustomTaskComponent:
                  path: str,
                  start_button: BaseComponent,
                  start_callback: Union[Callable, None],
-                 end_callback: Union[Callable, None]
+                 end_callback: Union[Callable, None],
+                 priority: int = 0
                 ):
         self.component = component
         self.path = path
         self.start_button = start_button
         self.start_callback = start_callback
         self.end_callback = end_callback
+        self.priority = priority
 
 
-def custom_task_component(func: Callable[[], CustomTaskComponent]):
+def custom_task_component(func: Union[Callable[[], CustomTaskComponent], None] = None, *,
+                          scheduler: Union[Scheduler, None] = None):
+    """Turns func's CustomTaskComponent into a widget. Used bare, jobs go to
+    default_scheduler; @custom_task_component(scheduler=...) picks another one."""
+    if func is None:
+        return lambda func: custom_task_component(func, scheduler=scheduler)
+    if scheduler is None:
+        scheduler = default_scheduler
     info = func()
 
     class Widget():
         def __init__(self):
+            self.job: Union[None, Job] = None
             info.start_button.on_click(self.on_start_callback)
 
         def __call__(self, *args, **kwargs):
             return info.component
 
         def on_exit_callback(self):
+            self.job = None
             if info.end_callback is not None:
                 info.end_callback()
 
         def on_start_callback(self):
-            self.process = Process(info.path, self.on_exit_callback)
-            if info.start_callback is not None:
-                info.start_callback()
+            job = self.job = Job(scheduler, info.path, self.on_exit_callback, info.start_callback,
+                                 info.priority, {})
+            scheduler.enqueue(job)
+
+        @property
+        def process(self) -> Union[None, Process]:
+            return self.job.process if self.job is not None else None
 
         def kill(self):
-            self.process.kill()
+            if self.job is not None:
+                self.job.cancel()
 
     return Widget()